@@ -6,13 +6,18 @@ import argparse
 import collections
 import itertools
 import math
+import multiprocessing
 import os
+import resource
 import shutil
 import sys
 import time
 from calendar import timegm
 from datetime import datetime
+import numpy as np
 from tqdm import tqdm
+from src.data_loader.session_store import COLUMNS, SessionStoreWriter, \
+    get_store_path
 from src.utils.qpath import *
 
 
@@ -76,6 +81,70 @@ def extract_time_context_raw(timestamp, ts_format='%Y-%m-%d %H:%M:%S'):
     return week_day, half_month_ped
 
 
+# Formats parsed by numpy datetime64, with the separator of date and time
+_ISO_FORMATS = {'%Y-%m-%dT%H:%M:%S%Z': 'T', '%Y-%m-%dT%H:%M:%S': 'T',
+                '%Y-%m-%d %H:%M:%S': ' '}
+
+
+def date2utc_batch(dates, ts_format='%Y-%m-%dT%H:%M:%S%Z'):
+    """
+    date2utc over an array of dates, as int64 seconds.
+    ISO formats are parsed by datetime64, other formats or dates
+    datetime64 would read differently from strptime fall back to date2utc.
+    """
+    dates = np.asarray(dates, dtype=str)
+    sep = _ISO_FORMATS.get(ts_format)
+    if sep is not None and dates.size:
+        stripped = dates
+        if ts_format.endswith('%Z'):
+            stripped = np.char.rstrip(dates, 'Z')
+        if np.all(np.char.str_len(stripped) == 19) and \
+                np.all(np.char.find(stripped, sep) == 10) and \
+                (stripped is dates or
+                 np.all(np.char.str_len(dates) == 20)):
+            try:
+                return np.array(stripped, dtype='datetime64[s]').astype(
+                    np.int64)
+            except ValueError:
+                pass
+    return np.array([date2utc(d, ts_format) for d in dates.tolist()],
+                    dtype=np.int64)
+
+
+def extract_time_context_utc_batch(utc):
+    """
+    extract_time_context_utc over an array of timestamps.
+    :return: hour, week day and half month arrays
+    """
+    # Microseconds rounded like datetime.utcfromtimestamp
+    frac, whole = np.modf(np.asarray(utc, dtype=np.float64))
+    us = whole.astype(np.int64) * 1000000 + \
+        np.round(frac * 1e6).astype(np.int64)
+    dt = us.astype('datetime64[us]')
+    days = dt.astype('datetime64[D]')
+    hour = ((dt - days) // np.timedelta64(1, 'h')).astype(np.int64)
+    # 1970-01-01 was a Thursday
+    week_day = (days.astype(np.int64) + 3) % 7
+    month_start = dt.astype('datetime64[M]')
+    month = month_start.astype(np.int64) % 12 + 1
+    day = (days - month_start.astype('datetime64[D]')).astype(np.int64) + 1
+    day_of_month = ((month_start + 1).astype('datetime64[D]') -
+                    month_start.astype('datetime64[D]')).astype(np.int64)
+    half_month_ped = np.where(day < day_of_month / 2,
+                              month * 2 - 1, month * 2)
+    return hour, week_day, half_month_ped
+
+
+def extract_time_context_raw_batch(timestamps, ts_format='%Y-%m-%d %H:%M:%S'):
+    """
+    extract_time_context_raw over an array of dates.
+    :return: week day and half month arrays
+    """
+    _, week_day, half_month_ped = extract_time_context_utc_batch(
+        date2utc_batch(timestamps, ts_format))
+    return week_day, half_month_ped
+
+
 def _parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--path', default=RAW_DATA_DIR + 'lastfm.tsv',
@@ -100,6 +169,19 @@ def _parse_args():
     parser.add_argument('--sep', type=str, default='\t')
     parser.add_argument('--prefix', type=str, default='')
     parser.add_argument('--suffix', type=str, default='')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='Processes parsing the raw file (1: serial)')
+    parser.add_argument('--chunk_mb', type=int, default=64,
+                        help='Size of the byte ranges parsed by a worker')
+    parser.add_argument('--pipeline',
+                        choices=['files', 'columnar', 'external'],
+                        default='files',
+                        help='Keep events in one file per user, as sorted '
+                             'columns or as sorted columns built from runs '
+                             'spilled to disk')
+    parser.add_argument('--memory_mb', type=int, default=0,
+                        help='Memory budget of the sorts and session splits '
+                             'of the columnar pipelines (0: no limit)')
     parser.add_argument('--op', choices=['split', 'all'],
                         help='''
                         [all] Preprocess data + Split session
@@ -127,6 +209,127 @@ def parse_data(args):
                 continue
 
 
+def get_chunks(path, chunk_size):
+    """
+    Split a file into byte ranges that start and end on line boundaries.
+    """
+    size = os.path.getsize(path)
+    chunks = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def parse_chunk(path, start, end, sep, pu, pi, pt, time_format, skip_first):
+    """
+    Parse the lines of a byte range like parse_data.
+    Ids (and timestamps without time_format) are returned as UTF-8 bytes
+    arrays, a quarter of the size of unicode arrays.
+    :return: users, items and timestamps as arrays, the number of lines
+             read and the (line index in chunk, line) pairs that raised
+             IndexError
+    """
+    users, items, timestamps, errors = [], [], [], []
+    num_lines = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        if skip_first and start == 0:
+            f.readline()
+        while f.tell() < end:
+            line = f.readline().decode('utf-8')
+            line_data = line.strip().split(sep)
+            try:
+                usr, item, ts = line_data[pu], line_data[pi], line_data[pt]
+                users.append(usr.encode('utf-8'))
+                items.append(item.encode('utf-8'))
+                timestamps.append(ts if time_format else ts.encode('utf-8'))
+            except IndexError:
+                errors.append((num_lines, line.strip()))
+            num_lines += 1
+    if time_format:
+        timestamps = date2utc_batch(timestamps, time_format)
+    return np.array(users, dtype=bytes), np.array(items, dtype=bytes), \
+        np.array(timestamps, dtype=np.int64 if time_format else bytes), \
+        num_lines, errors
+
+
+# Size of the arrays of a parsed chunk relative to its bytes in the file
+_CHUNK_EXPANSION = 4
+
+
+def get_chunk_size(args):
+    """
+    Bytes per parse task, --chunk_mb capped so that the chunks in flight
+    (num_workers being parsed or waiting, one being consumed) fit in
+    --memory_mb.
+    """
+    chunk_size = args.chunk_mb * 1024 * 1024
+    if args.memory_mb > 0:
+        chunk_size = min(chunk_size, args.memory_mb * 1024 * 1024 // (
+            _CHUNK_EXPANSION * (args.num_workers + 1)))
+    return max(chunk_size, 64 * 1024)
+
+
+def parse_data_parallel(args):
+    """
+    Parse the raw file in a process pool, one byte range per task.
+    At most num_workers tasks are in flight, so parsed chunks do not pile
+    up when the consumer is slower than the workers.
+    Yields (users, items, timestamps) arrays in file order.
+    """
+    chunks = get_chunks(args.path, get_chunk_size(args))
+    tasks = [(args.path, start, end, args.sep, args.pu, args.pi, args.pt,
+              args.time_format, args.skip_first) for start, end in chunks]
+    line_offset = 0
+    with multiprocessing.Pool(args.num_workers) as pool:
+        pending = collections.deque(
+            pool.apply_async(parse_chunk, task)
+            for task in tasks[:args.num_workers])
+        for t in tqdm(range(len(tasks))):
+            users, items, timestamps, num_lines, errors = \
+                pending.popleft().get()
+            if t + args.num_workers < len(tasks):
+                pending.append(pool.apply_async(
+                    parse_chunk, tasks[t + args.num_workers]))
+            for i, line in errors:
+                print("IndexError: list index out of range for line {} "
+                      "('{}'), ignoring".format(line_offset + i, line))
+            line_offset += num_lines
+            yield users, items, timestamps
+
+
+def _decode(values):
+    if values.dtype.kind == 'S':
+        return np.char.decode(values, 'utf-8')
+    return values
+
+
+def iter_events(chunks):
+    for users, items, timestamps in chunks:
+        for event in zip(_decode(users).tolist(), _decode(items).tolist(),
+                         _decode(timestamps).tolist()):
+            yield event
+
+
+def event_chunks(stream, chunk_size=1000000):
+    """
+    Group a (user, item, ts) stream into arrays like parse_data_parallel.
+    """
+    while True:
+        events = list(itertools.islice(stream, chunk_size))
+        if not events:
+            return
+        users, items, timestamps = zip(*events)
+        yield np.array(users, dtype=str), np.array(items, dtype=str), \
+            np.array(timestamps)
+
+
 def preprocess(args, stream):
     data = list()
     occurrences = collections.defaultdict(lambda: 0)
@@ -277,119 +480,560 @@ def save_user_session(args, sessions):
         train_idx = int(len(sessions) * 0.9)
         dev_idx = train_idx + int(len(sessions) * 0.05)
 
-    with open(PROCESSED_DATA_DIR + '{}train{}'.format(
-            args.prefix, args.suffix), 'a') as f1:
-        for sess in sessions[:train_idx]:
-            for s in sess:
-                h, d, m = extract_time_context_utc(s[2])
-                f1.write('{},{},{},{},{}\n'.format(s[0], s[1], h, d, m))
-            f1.write('-----\n')
-    with open(PROCESSED_DATA_DIR + '{}dev{}'.format(
-            args.prefix, args.suffix), 'a') as f1:
-        for sess in sessions[train_idx:dev_idx]:
-            for s in sess:
-                h, d, m = extract_time_context_utc(s[2])
-                f1.write('{},{},{},{},{}\n'.format(s[0], s[1], h, d, m))
-            f1.write('-----\n')
-    with open(PROCESSED_DATA_DIR + '{}test{}'.format(
-            args.prefix, args.suffix), 'a') as f1:
-        for sess in sessions[dev_idx:]:
+    for split, split_sessions in zip(
+            ['train', 'dev', 'test'],
+            [sessions[:train_idx], sessions[train_idx:dev_idx],
+             sessions[dev_idx:]]):
+        write_sessions(PROCESSED_DATA_DIR + '{}{}{}'.format(
+            args.prefix, split, args.suffix), split_sessions)
+
+
+def write_sessions(path, sessions):
+    hours, days, months = extract_time_context_utc_batch(
+        [float(s[2]) for sess in sessions for s in sess])
+    i = 0
+    with open(path, 'a') as f1:
+        for sess in sessions:
             for s in sess:
-                h, d, m = extract_time_context_utc(s[2])
-                f1.write('{},{},{},{},{}\n'.format(s[0], s[1], h, d, m))
+                f1.write('{},{},{},{},{}\n'.format(
+                    s[0], s[1], hours[i], days[i], months[i]))
+                i += 1
             f1.write('-----\n')
 
 
-def clean_data(path, file, train_items, users_map, items_map):
-    new_data = []
-    with open(path + file, 'r') as f:
-        for line in f:
-            if '-' in line:
-                new_data.append(line)
-                continue
-            data = line.strip().split(',')
-            if train_items[int(data[1])] == 0:
-                continue
-            new_data.append(data)
+# Working memory per event of the columnar sorts, merges and splits
+_BYTES_PER_EVENT = 64
+_EVENT_COLUMNS = ['user', 'item', 'ts']
 
-    event_count = 0
-    with open(path + 'clean-' + file, 'w') as f:
-        for data in new_data:
-            if '-' in data:
-                f.write(data)
-                continue
-            event_count += 1
-            f.write('{},{},{},{},{}\n'.format(users_map[int(data[0])],
-                                              items_map[int(data[1])],
-                                              data[2], data[3], data[4]))
-    print('- clean-{}: {} events'.format(file, event_count))
-    os.remove(path + file)
 
+def get_events_dir(args):
+    return PROCESSED_DATA_DIR + '{}events{}'.format(args.prefix, args.suffix)
 
-def remove_unseen_data(args):
-    users = set()
-    items = set()
-    train_items = collections.defaultdict(lambda: 0)
-
-    with open(PROCESSED_DATA_DIR + '{}train{}'.format(
-            args.prefix, args.suffix), 'r') as f:
-        for line in f:
-            if '-' in line:
-                continue
-            data = line.strip().split(',')
-            users.add(int(data[0]))
-            items.add(int(data[1]))
-            train_items[int(data[1])] = 1
-
-    with open(PROCESSED_DATA_DIR + '{}test{}'.format(
-            args.prefix, args.suffix), 'r') as f:
-        for line in f:
-            if '-' in line:
-                continue
-            data = line.strip().split(',')
-            if train_items[int(data[1])] == 0:
-                continue
-            users.add(int(data[0]))
 
-    with open(PROCESSED_DATA_DIR + '{}dev{}'.format(
-            args.prefix, args.suffix), 'r') as f:
-        for line in f:
-            if '-' in line:
-                continue
-            data = line.strip().split(',')
-            if train_items[int(data[1])] == 0:
-                continue
-            users.add(int(data[0]))
+def get_block_events(args):
+    """
+    Events processed at once under --memory_mb, 0 for no limit.
+    """
+    if args.memory_mb <= 0:
+        return 0
+    return max(args.memory_mb * 1024 * 1024 // _BYTES_PER_EVENT, 1000)
 
-    users_map = dict(zip(users, range(1, len(users) + 1)))
-    items_map = dict(zip(items, range(1, len(items) + 1)))
-    print('Third filter (remove item not exist in the train set): ')
+
+def get_peak_rss_mb():
+    """
+    :return: peak RSS of this process and of its largest child process
+    """
+    return tuple(resource.getrusage(who).ru_maxrss / 1024.
+                 for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN])
+
+
+def save_columns(path, columns):
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, column in columns.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), column)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def load_columns(path, names=_EVENT_COLUMNS, mmap=True):
+    return [np.load(os.path.join(path, name + '.npy'),
+                    mmap_mode='r' if mmap else None) for name in names]
+
+
+def preprocess_columnar(args, chunks):
+    """
+    preprocess() over (users, items, timestamps) array chunks. The filtered
+    events are kept as user, item and ts columns sorted by (user, ts, item)
+    in one directory of .npy files instead of one file per user. Users and
+    items are numbered in sorted order, so the order is the one of
+    split_session.
+    """
+    users, items, timestamps = [np.concatenate(c) for c in zip(*chunks)]
+
+    # Remove items that occurred infrequently
+    _, item_ids, occurrences = np.unique(items, return_inverse=True,
+                                         return_counts=True)
+    keep = occurrences[item_ids] >= args.min_occur
+    items, item_ids = np.unique(items[keep], return_inverse=True)
+    users, user_ids = np.unique(users[keep], return_inverse=True)
+    timestamps = timestamps[keep].astype(np.float64)
+    print('First filter (item occur < {}): '.format(args.min_occur))
     print('- Num users: ', len(users))
     print('- Num items: ', len(items))
+    print('- Num events: ', int(keep.sum()))
+    del keep
+
+    order = np.lexsort((item_ids, timestamps, user_ids))
+    save_columns(get_events_dir(args), {
+        'user': (user_ids[order] + 1).astype(np.int32),
+        'item': (item_ids[order] + 1).astype(np.int32),
+        'ts': timestamps[order]})
+
 
-    clean_data(PROCESSED_DATA_DIR, '{}train{}'.format(
-        args.prefix, args.suffix),
-        train_items, users_map, items_map)
-    clean_data(PROCESSED_DATA_DIR, '{}test{}'.format(
-        args.prefix, args.suffix),
-        train_items, users_map, items_map)
-    clean_data(PROCESSED_DATA_DIR, '{}dev{}'.format(
-        args.prefix, args.suffix),
-        train_items, users_map, items_map)
+def _lookup(vocab, values):
+    """
+    Ids of values in vocab, adding the new ones.
+    """
+    unique, inverse = np.unique(values, return_inverse=True)
+    ids = np.array([vocab.setdefault(v, len(vocab)) for v in unique.tolist()],
+                   dtype=np.int32)
+    return ids[inverse]
+
+
+def _key_le(columns, bound):
+    """
+    Mask of the (user, ts, item) keys that are <= bound.
+    """
+    user, ts, item = columns
+    bu, bt, bi = bound
+    return (user < bu) | ((user == bu) & (
+        (ts < bt) | ((ts == bt) & (item <= bi))))
+
+
+def preprocess_external(args, chunks):
+    """
+    preprocess_columnar for logs that do not fit in memory. Events are
+    numbered by first occurrence and spilled in runs of get_block_events;
+    once the item counts are known every run is filtered, renumbered in
+    sorted order and sorted by (user, ts, item), and the runs are merged
+    block by block into the columns of get_events_dir.
+    """
+    block_events = get_block_events(args) or 1000000
+    run_dir = get_events_dir(args) + '.runs'
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+
+    def run_path(r, name):
+        return os.path.join(run_dir, '{}-{}.npy'.format(r, name))
+
+    def spill(buffer):
+        for name, column in zip(['user', 'item', 'ts'], zip(*buffer)):
+            np.save(run_path(len(runs), name), np.concatenate(column))
+        runs.append(sum(len(b[0]) for b in buffer))
+
+    # Spill runs numbered by first occurrence and count the items
+    user_vocab, item_vocab = {}, {}
+    occurrences = np.zeros(0, dtype=np.int64)
+    runs, buffer, buffered = [], [], 0
+    for users, items, timestamps in chunks:
+        user_ids = _lookup(user_vocab, users)
+        item_ids = _lookup(item_vocab, items)
+        counts = np.bincount(item_ids, minlength=len(item_vocab))
+        counts[:len(occurrences)] += occurrences
+        occurrences = counts
+        buffer.append((user_ids, item_ids, timestamps.astype(np.float64)))
+        buffered += len(user_ids)
+        if buffered >= block_events:
+            spill(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        spill(buffer)
+
+    # Renumber in sorted order, 0 for infrequent items
+    item_names = np.array(list(item_vocab))
+    user_names = np.array(list(user_vocab))
+    del item_vocab, user_vocab
+    frequent = np.flatnonzero(occurrences >= args.min_occur)
+    item_map = np.zeros(len(item_names), dtype=np.int32)
+    item_map[frequent[np.argsort(item_names[frequent])]] = \
+        np.arange(1, len(frequent) + 1)
+    user_map = np.empty(len(user_names), dtype=np.int32)
+    user_map[np.argsort(user_names)] = np.arange(1, len(user_names) + 1)
+    del item_names, user_names
+
+    # Sort the runs
+    has_events = np.zeros(len(user_map) + 1, dtype=bool)
+    for r in tqdm(range(len(runs))):
+        user, item, ts = [np.load(run_path(r, name))
+                          for name in ['user', 'item', 'ts']]
+        keep = item_map[item] > 0
+        user, item, ts = user_map[user[keep]], item_map[item[keep]], ts[keep]
+        has_events[user] = True
+        order = np.lexsort((item, ts, user))
+        for name, column in zip(['user', 'item', 'ts'], [user, item, ts]):
+            np.save(run_path(r, name), column[order])
+        runs[r] = len(order)
+    # Users without events are not numbered
+    user_ids = np.cumsum(has_events).astype(np.int32)
+    num_events = sum(runs)
+    print('First filter (item occur < {}): '.format(args.min_occur))
+    print('- Num users: ', int(has_events.sum()))
+    print('- Num items: ', len(frequent))
+    print('- Num events: ', num_events)
+
+    # Merge the runs
+    run_columns = [[np.load(run_path(r, name), mmap_mode='r')
+                    for name in ['user', 'ts', 'item']]
+                   for r in range(len(runs))]
+    events_dir = get_events_dir(args)
+    tmp_dir = events_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    out = {name: np.lib.format.open_memmap(
+        os.path.join(tmp_dir, name + '.npy'), mode='w+',
+        dtype=np.float64 if name == 'ts' else np.int32, shape=(num_events,))
+        for name in _EVENT_COLUMNS}
+    merge_block = max(block_events // max(len(runs), 1), 1)
+    positions = [0] * len(runs)
+    written = 0
+    with tqdm(total=num_events) as progress:
+        while written < num_events:
+            blocks = {r: [c[positions[r]:positions[r] + merge_block]
+                          for c in run_columns[r]]
+                      for r in range(len(runs)) if positions[r] < runs[r]}
+            # Keys up to the smallest last key of a partial block are final
+            bounds = [tuple(c[-1] for c in block)
+                      for r, block in blocks.items()
+                      if positions[r] + merge_block < runs[r]]
+            pieces = []
+            for r, block in blocks.items():
+                if bounds:
+                    block = [c[:np.count_nonzero(_key_le(block, min(bounds)))]
+                             for c in block]
+                positions[r] += len(block[0])
+                pieces.append(block)
+            user, ts, item = [np.concatenate(c) for c in zip(*pieces)]
+            order = np.lexsort((item, ts, user))
+            end = written + len(order)
+            out['user'][written:end] = user_ids[user[order]]
+            out['item'][written:end] = item[order]
+            out['ts'][written:end] = ts[order]
+            progress.update(len(order))
+            written = end
+    for column in out.values():
+        column.flush()
+    del out, run_columns
+    if os.path.exists(events_dir):
+        shutil.rmtree(events_dir)
+    os.rename(tmp_dir, events_dir)
+    shutil.rmtree(run_dir)
+
+
+def _next_outside(ts, anchors, ends, time_interval):
+    """
+    Binary search, for every anchor, of the first index in (anchor, end)
+    whose ts is not within time_interval of the anchor.
+    """
+    lo, hi = anchors + 1, ends.copy()
+    while True:
+        active = lo < hi
+        if not active.any():
+            return lo
+        mid = np.minimum((lo + hi) // 2, len(ts) - 1)
+        within = active & (np.abs(ts[mid] - ts[anchors]) < time_interval)
+        lo = np.where(within, mid + 1, lo)
+        hi = np.where(active & ~within, mid, hi)
+
+
+def remove_repeats(user, item, ts, time_interval):
+    """
+    Mask of the events split_session keeps: an event is dropped when it
+    repeats the item of the last kept event within time_interval of it.
+    Inside each run of one (user, item), kept events are found by jumping
+    from a kept event to the first one at least time_interval later.
+    """
+    run_start = np.ones(len(user), dtype=bool)
+    run_start[1:] = (user[1:] != user[:-1]) | (item[1:] != item[:-1])
+    kept = run_start.copy()
+    anchors = np.flatnonzero(run_start)
+    ends = np.append(anchors[1:], len(user))
+    repeated = ends - anchors > 1
+    anchors, ends = anchors[repeated], ends[repeated]
+    while len(anchors):
+        anchors = _next_outside(ts, anchors, ends, time_interval)
+        found = anchors < ends
+        anchors, ends = anchors[found], ends[found]
+        kept[anchors] = True
+    return kept
+
+
+def user_blocks(user, block_events):
+    """
+    [start, end) ranges of about block_events events that do not split a
+    user, the whole column if block_events is 0.
+    """
+    start = 0
+    while start < len(user):
+        end = len(user) if block_events <= 0 else \
+            min(start + block_events, len(user))
+        if end < len(user):
+            end = np.searchsorted(user, user[end])
+            if end == start:
+                end = np.searchsorted(user, user[start], side='right')
+        yield start, int(end)
+        start = int(end)
+
+
+def split_session_columnar(args):
+    """
+    split_session over the columns of preprocess_columnar, a block of
+    users at a time: sessions, cutting and the train/dev/test split are
+    computed on index arrays.
+    """
+    user, item, ts = load_columns(get_events_dir(args))
+    files = [open(PROCESSED_DATA_DIR + '{}{}{}'.format(
+        args.prefix, split, args.suffix), 'w')
+        for split in ['train', 'dev', 'test']]
+    counts = np.zeros(4, dtype=np.int64)
+    for start, end in tqdm(list(user_blocks(user, get_block_events(args)))):
+        counts += split_block(args, np.asarray(user[start:end]),
+                              np.asarray(item[start:end]),
+                              np.asarray(ts[start:end]), files)
+    for f in files:
+        f.close()
+
+    num_origin_sessions, num_cut_sessions, num_events, num_users = \
+        counts.tolist()
+    print('Second filter ' +
+          '(session length >= {} and sessions per user > {}): '.format(
+              args.min_session_len, args.min_session_per_user))
+    print('- Total origin sessions', num_origin_sessions)
+    print('- Total cut sessions: ', num_cut_sessions)
+    print('- Event per origin sessions ',
+          float(num_events) / num_origin_sessions)
+    print('- Event per cut sessions ', float(num_events) / num_cut_sessions)
+    print('- Total events: ', num_events)
+    print('- Average sessions length: ',
+          float(num_events) / num_origin_sessions)
+    print('- Sessions per user: ', float(num_origin_sessions) / num_users)
+
+
+def split_block(args, user, item, ts, files):
+    """
+    Split the events of whole users and write their cut sessions to the
+    train, dev and test files.
+    :return: origin sessions, cut sessions, events and users kept
+    """
+    kept = remove_repeats(user, item, ts, args.time_interval)
+    user, item, ts = user[kept], item[kept], ts[kept]
+
+    # Sessions
+    new_session = np.ones(len(user), dtype=bool)
+    new_session[1:] = (user[1:] != user[:-1]) | \
+        ~(np.abs(np.diff(ts)) < args.time_interval)
+    starts = np.flatnonzero(new_session)
+    lengths = np.diff(np.append(starts, len(user)))
+    valid = (lengths > 1) & (lengths <= args.max_valid_seq_len)
+    starts, lengths = starts[valid], lengths[valid]
+    # Users of the block numbered from 0
+    session_user = user[starts] - user[0]
+
+    # Cutting, consecutive cut sessions share one event
+    num_cuts = (lengths - 1) // args.max_session_len + 1
+    cut_session = np.repeat(np.arange(len(starts)), num_cuts)
+    cut_index = np.arange(len(cut_session)) - \
+        np.repeat(np.cumsum(num_cuts) - num_cuts, num_cuts)
+    cut_starts = starts[cut_session] + cut_index * args.max_session_len
+    cut_ends = np.minimum(cut_starts + args.max_session_len + 1,
+                          (starts + lengths)[cut_session])
+    long_enough = cut_ends - cut_starts >= args.min_session_len
+    cut_session = cut_session[long_enough]
+    cut_starts, cut_ends = cut_starts[long_enough], cut_ends[long_enough]
+    cut_user = session_user[cut_session]
+
+    # Users with enough sessions and the train/dev/test split of theirs
+    num_users = user[-1] - user[0] + 1 if len(user) else 0
+    user_sessions = np.bincount(session_user, minlength=num_users)
+    user_events = np.bincount(session_user, weights=lengths,
+                              minlength=num_users)
+    user_cuts = np.bincount(cut_user, minlength=num_users)
+    selected = user_sessions >= args.min_session_per_user
+    selected_cuts = selected[cut_user]
+    cut_user = cut_user[selected_cuts]
+    cut_starts, cut_ends = cut_starts[selected_cuts], cut_ends[selected_cuts]
+    # Cut sessions are grouped by user
+    cut_rank = np.arange(len(cut_user)) - np.searchsorted(cut_user, cut_user)
+    n = user_cuts[cut_user]
+    train_idx = np.where(n <= 20, n - 2, (n * 0.9).astype(np.int64))
+    dev_idx = np.where(n <= 20, n - 1,
+                       train_idx + (n * 0.05).astype(np.int64))
+    cut_split = (cut_rank >= train_idx).astype(np.int64) + \
+        (cut_rank >= dev_idx)
+
+    hours, days, months = extract_time_context_utc_batch(ts)
+    for i, f in enumerate(files):
+        in_split = cut_split == i
+        write_columnar_sessions(f, [user, item, hours, days, months],
+                                cut_starts[in_split], cut_ends[in_split])
+    return np.array([user_sessions[selected].sum(),
+                     user_cuts[selected].sum(),
+                     user_events[selected].sum(), selected.sum()],
+                    dtype=np.int64)
+
+
+def write_columnar_sessions(f, columns, starts, ends, block_size=100000):
+    """
+    Write the sessions [starts[i], ends[i]) of event columns in the format
+    of write_sessions.
+    """
+    for b in range(0, len(starts), block_size):
+        lengths = ends[b:b + block_size] - starts[b:b + block_size]
+        index = np.arange(lengths.sum()) + np.repeat(
+            starts[b:b + block_size] - (np.cumsum(lengths) - lengths),
+            lengths)
+        lines = ['{},{},{},{},{}\n'.format(*e)
+                 for e in zip(*[c[index].tolist() for c in columns])]
+        pos = 0
+        for length in lengths.tolist():
+            f.write(''.join(lines[pos:pos + length]) + '-----\n')
+            pos += length
+
+
+def _load_spilled(path, dtype, columns=None):
+    if os.path.getsize(path) == 0:
+        data = np.zeros(0, dtype=dtype)
+    else:
+        data = np.memmap(path, dtype=dtype, mode='r')
+    return data if columns is None else data.reshape([-1, columns])
+
+
+def read_sessions(path, tmp_path, chunk_size=1000000):
+    """
+    Read a session text file once, chunk_size lines at a time, into int32
+    event rows and the number of events before every separator, spilled
+    to <tmp_path>.events and <tmp_path>.ends.
+    :return: memory-mapped [num_events, 5] events and separator ends
+    """
+    num_events = 0
+    with open(path, 'r') as f, open(tmp_path + '.events', 'wb') as fe, \
+            open(tmp_path + '.ends', 'wb') as fs:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            is_sep = np.array(['-' in line for line in lines], dtype=bool)
+            event_lines = [line.strip() for line, sep in zip(lines, is_sep)
+                           if not sep]
+            if event_lines:
+                np.array(','.join(event_lines).split(','), dtype=np.int64) \
+                    .astype(np.int32).tofile(fe)
+            (num_events + np.cumsum(~is_sep)[is_sep]).tofile(fs)
+            num_events += len(event_lines)
+    return _load_spilled(tmp_path + '.events', np.int32, len(COLUMNS)), \
+        _load_spilled(tmp_path + '.ends', np.int64)
+
+
+def write_clean_sessions(path, events, ends, user_map, item_map,
+                         block_size=100000):
+    """
+    Write the events whose item has a new id, renumbered through the remap
+    arrays, as a session text file and its compiled session store.
+    Events after the last separator are only written to the text file.
+    :return: number of events written
+    """
+    event_count = 0
+    store_path = get_store_path(path)
+    with open(path, 'w') as f, SessionStoreWriter(store_path) as writer:
+        start = 0
+        for b in range(0, len(ends) + 1, block_size):
+            block_ends = ends[b:b + block_size]
+            tail = b + block_size > len(ends)
+            end = len(events) if tail else int(block_ends[-1])
+            block = np.array(events[start:end])
+            keep = item_map[block[:, 1]] >= 0
+            block = block[keep]
+            block[:, 0] = user_map[block[:, 0]]
+            block[:, 1] = item_map[block[:, 1]]
+            kept_before = np.concatenate([[0], np.cumsum(keep)])
+            bounds = kept_before[np.concatenate([[0], block_ends - start])]
+            lengths = np.diff(bounds)
+
+            lines = ['{},{},{},{},{}\n'.format(*e) for e in block.tolist()]
+            pos = 0
+            for length in lengths.tolist():
+                f.write(''.join(lines[pos:pos + length]) + '-----\n')
+                pos += length
+            f.write(''.join(lines[pos:]))
+            writer.add_sessions(block[:pos], lengths)
+            event_count += len(block)
+            start = end
+    print('- {}: {} events, compiled to {}'.format(
+        os.path.basename(path), event_count, store_path))
+    return event_count
+
+
+def remove_unseen_data(args):
+    """
+    Keep the items of the train set and the users with events left, each
+    split file read once. Users and items get new ids in the order of their
+    old ones through dense remap arrays (-1 for removed ids); the clean text
+    files, their session stores and the metadata file are written from the
+    spilled events.
+    """
+    splits = ['train', 'test', 'dev']
+    paths = [PROCESSED_DATA_DIR + '{}{}{}'.format(
+        args.prefix, split, args.suffix) for split in splits]
+    spilled = [read_sessions(path, path + '.tmp') for path in paths]
+
+    def bincount(ids, size):
+        return np.bincount(ids, minlength=size)[:size] if len(ids) \
+            else np.zeros(size, dtype=np.int64)
+
+    num_items = max([int(e[:, 1].max()) + 1 for e, _ in spilled if len(e)] +
+                    [1])
+    num_users = max([int(e[:, 0].max()) + 1 for e, _ in spilled if len(e)] +
+                    [1])
+    train_events = spilled[0][0]
+    train_items = bincount(train_events[:, 1], num_items) > 0
+    users = bincount(train_events[:, 0], num_users) > 0
+    for events, _ in spilled[1:]:
+        users |= bincount(events[train_items[events[:, 1]], 0], num_users) > 0
+
+    item_map = np.where(train_items, np.cumsum(train_items), -1)
+    user_map = np.where(users, np.cumsum(users), -1)
+    print('Third filter (remove item not exist in the train set): ')
+    print('- Num users: ', int(users.sum()))
+    print('- Num items: ', int(train_items.sum()))
     with open(PROCESSED_DATA_DIR +
               'clean-{}train{}-metadata'.format(
                   args.prefix, args.suffix), 'w') as f:
-        f.write(str(len(items)) + '\n')
-        f.write(str(len(users)) + '\n')
+        f.write(str(int(train_items.sum())) + '\n')
+        f.write(str(int(users.sum())) + '\n')
         f.write(str(args.max_session_len))
 
+    for split, path, (events, ends) in zip(splits, paths, spilled):
+        write_clean_sessions(PROCESSED_DATA_DIR + 'clean-{}{}{}'.format(
+            args.prefix, split, args.suffix), events, ends, user_map,
+            item_map)
+    del spilled, train_events
+    for path in paths:
+        for tmp in ['.tmp.events', '.tmp.ends']:
+            os.remove(path + tmp)
+        os.remove(path)
+
 
 if __name__ == '__main__':
     args = _parse_args()
     # Preprocess data & create train - val - test
-    if args.op == 'all':
-        stream = parse_data(args)
+    if args.op == 'all' and args.pipeline != 'files':
+        if args.num_workers > 1:
+            chunks = parse_data_parallel(args)
+        else:
+            chunks = event_chunks(parse_data(args),
+                                  get_block_events(args) // 4 or 1000000)
+        if args.pipeline == 'external':
+            preprocess_external(args, chunks)
+        else:
+            preprocess_columnar(args, chunks)
+    elif args.op == 'all':
+        if args.num_workers > 1:
+            stream = iter_events(parse_data_parallel(args))
+        else:
+            stream = parse_data(args)
         preprocess(args, stream)
 
-    split_session(args)
+    if args.pipeline != 'files':
+        split_session_columnar(args)
+    else:
+        split_session(args)
     remove_unseen_data(args)
+    peak_rss, peak_worker_rss = get_peak_rss_mb()
+    print('Peak RSS: {:.1f}MB{} - largest parse worker: {:.1f}MB'.format(
+        peak_rss, ' (budget: {}MB)'.format(args.memory_mb)
+        if args.memory_mb > 0 else '', peak_worker_rss))
@@ -1,9 +1,15 @@
+import sys
+sys.path.append('../..')  # noqa
+
 import numpy as np
 
+from src.data_loader.session_store import SessionStore, get_store_path
+
 
 class DataLoader(object):
-    def __init__(self, path, config):
+    def __init__(self, path, config, shard=None):
         self._path = path
+        self._shard = shard
         self._max_length = config.max_length
         self._batch_size = config.batch_size
         self._batch_index = -1
@@ -15,6 +21,44 @@ class DataLoader(object):
         self.load_data()
 
     def load_data(self):
+        store_path = get_store_path(self._path)
+        if SessionStore.exists(store_path):
+            self.load_store(store_path)
+        else:
+            self.load_text()
+
+        self._num_events_eval = self._num_events - len(self._data)
+        self._num_batch = \
+            int(float(len(self._data) - 1) / self._batch_size) + 1
+
+        print('--- Data ---')
+        print('Path: ', self._path)
+        print('Num sessions: ', len(self._data))
+        print('Num events: ', self._num_events)
+
+    def shard_range(self, num_sessions):
+        """
+        Session range of this loader's shard. Shards are aligned to whole
+        batches so they reproduce the batches of the unsharded loader.
+        """
+        if self._shard is None:
+            return 0, num_sessions
+        index, num_shards = self._shard
+        num_batch = int(float(num_sessions - 1) / self._batch_size) + 1
+        start = index * num_batch // num_shards * self._batch_size
+        end = (index + 1) * num_batch // num_shards * self._batch_size
+        return min(start, num_sessions), min(end, num_sessions)
+
+    def load_store(self, store_path):
+        store = SessionStore(store_path)
+        lengths = store.lengths()
+        valid = np.flatnonzero(lengths > 1)
+        start, end = self.shard_range(len(valid))
+        valid = valid[start:end]
+        self._num_events = int(lengths[valid].sum())
+        self._data = store.gather(valid, self._max_length)
+
+    def load_text(self):
         self._data = []
         self._num_events = 0
         session = []
@@ -32,13 +76,26 @@ class DataLoader(object):
                     session.append([int(j) for j in line.strip().split(',')])
 
         self._data = np.array(self._data, dtype=np.int32)
-        self._num_events_eval = self._num_events - len(self._data)
-        self._num_batch = int(float(len(self._data) - 1) / self._batch_size) + 1
+        if self._shard is not None:
+            start, end = self.shard_range(len(self._data))
+            self._data = self._data[start:end]
+            self._num_events = int(np.count_nonzero(self._data[:, :, 1]))
 
-        print('--- Data ---')
-        print('Path: ', self._path)
-        print('Num sessions: ', len(self._data))
-        print('Num events: ', self._num_events)
+    def get_session_indices(self):
+        return np.arange(len(self._data))
+
+    def gather(self, indices):
+        return self._data[indices]
+
+    def get_num_sessions(self):
+        return len(self._data)
+
+    def get_item_counts(self, num_items):
+        counts = np.bincount(self._data[:, :, 1].ravel(),
+                             minlength=num_items + 1) + 1
+        # Padding is not an item, it is never sampled as a negative
+        counts[0] = 0
+        return counts
 
     def next_epoch(self, shuffle=False):
         if shuffle:
@@ -55,3 +112,113 @@ class DataLoader(object):
 
     def has_next(self):
         return self._batch_index != -1
+
+
+class StreamingDataLoader(object):
+    """
+    Out-of-core counterpart of DataLoader.
+    Sessions are read block by block from the memory-mapped session store,
+    shuffled per block and inside a bounded shuffle buffer, so peak memory
+    depends on block_size and shuffle_buffer only.
+    """
+    def __init__(self, path, config):
+        self._path = path
+        self._max_length = config.max_length
+        self._batch_size = config.batch_size
+        self._block_size = config.block_size
+        self._shuffle_buffer = config.shuffle_buffer
+        self._batches = None
+        self._next_idx = None
+
+        store_path = get_store_path(path)
+        if not SessionStore.exists(store_path):
+            raise IOError('Streaming mode needs a compiled session store: '
+                          '{}'.format(store_path))
+        self._store = SessionStore(store_path)
+
+        # Per-epoch counters
+        self.num_batches_served = 0
+        self.num_sessions_served = 0
+        self.num_events_served = 0
+        self.num_events_eval_served = 0
+
+        print('--- Data (streaming) ---')
+        print('Path: ', self._path)
+        print('Num stored sessions: ', self._store.num_sessions)
+        print('Num stored events: ', self._store.num_events)
+
+    def _iter_batches(self, shuffle):
+        num_sessions = self._store.num_sessions
+        num_blocks = int(float(num_sessions - 1) / self._block_size) + 1 \
+            if num_sessions > 0 else 0
+        if shuffle:
+            blocks = np.random.permutation(num_blocks)
+            buffer_size = self._shuffle_buffer
+        else:
+            blocks = np.arange(num_blocks)
+            buffer_size = 0
+
+        pending = np.zeros(0, dtype=np.int64)
+        for b in blocks:
+            start = b * self._block_size
+            end = min(start + self._block_size, num_sessions)
+            lengths = np.diff(self._store.offsets[start:end + 1])
+            pending = np.concatenate(
+                [pending, start + np.flatnonzero(lengths > 1)])
+            if shuffle:
+                np.random.shuffle(pending)
+            while len(pending) >= buffer_size + self._batch_size:
+                yield pending[:self._batch_size]
+                pending = pending[self._batch_size:]
+
+        if shuffle:
+            np.random.shuffle(pending)
+        while len(pending) > 0:
+            yield pending[:self._batch_size]
+            pending = pending[self._batch_size:]
+
+    def get_session_indices(self):
+        return np.flatnonzero(self._store.lengths() > 1)
+
+    def gather(self, indices):
+        return self._store.gather(indices, self._max_length)
+
+    def get_item_counts(self, num_items):
+        counts = np.zeros(num_items + 1, dtype=np.int64)
+        items = self._store.columns['item']
+        for start in range(0, len(items), self._block_size * 10):
+            counts += np.bincount(items[start:start + self._block_size * 10],
+                                  minlength=num_items + 1)
+        counts += 1
+        # Padding is not an item, it is never sampled as a negative
+        counts[0] = 0
+        return counts
+
+    def next_epoch(self, shuffle=False):
+        self._batches = self._iter_batches(shuffle)
+        self._next_idx = next(self._batches, None)
+        self.num_batches_served = 0
+        self.num_sessions_served = 0
+        self.num_events_served = 0
+        self.num_events_eval_served = 0
+
+    def next_batch(self):
+        idx = self._next_idx
+        self._next_idx = next(self._batches, None)
+        batch = self._store.gather(idx, self._max_length)
+        num_events = int((self._store.offsets[idx + 1] -
+                          self._store.offsets[idx]).sum())
+        self.num_batches_served += 1
+        self.num_sessions_served += len(batch)
+        self.num_events_served += num_events
+        self.num_events_eval_served += num_events - len(batch)
+        return batch
+
+    def has_next(self):
+        return self._next_idx is not None
+
+
+def get_data_loader(path, config):
+    if config.streaming:
+        return StreamingDataLoader(path, config)
+    return DataLoader(path, config)
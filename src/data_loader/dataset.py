@@ -0,0 +1,77 @@
+import numpy as np
+import tensorflow as tf
+
+
+def _split_columns(batch_data):
+    return {
+        'user': batch_data[:, :-1, 0],
+        'item': batch_data[:, :-1, 1],
+        'day_of_week': batch_data[:, :-1, 3],
+        'month_period': batch_data[:, :-1, 4],
+        'next_items': batch_data[:, 1:, 1]
+    }
+
+
+class SessionDataset(object):
+    """
+    In-graph input pipeline for UserGruModel over the data loader given to
+    initialize, a DataLoader or a StreamingDataLoader.
+    A generator yields blocks of session indices (shuffled per epoch when
+    training) and parallel map calls gather the padded sessions of every
+    block from the loader, so only one block per call is copied into the
+    runtime. Shuffling, batching, column splitting and prefetching then run
+    inside TF.
+    """
+    def __init__(self, config):
+        self._max_length = config.max_length
+        self._batch_size = config.batch_size
+        self._block_size = config.block_size
+        self._shuffle_buffer = config.shuffle_buffer
+        self._num_parallel_calls = config.num_parallel_calls
+        self._prefetch = max(config.prefetch_depth, 1)
+        self._data_loader = None
+
+        train_dataset = self._build(shuffle=True)
+        eval_dataset = self._build(shuffle=False)
+
+        self.iterator = tf.data.Iterator.from_structure(
+            train_dataset.output_types, train_dataset.output_shapes)
+        self._initializers = {
+            True: self.iterator.make_initializer(train_dataset),
+            False: self.iterator.make_initializer(eval_dataset)
+        }
+        self.inputs = self.iterator.get_next()
+
+    def _index_blocks(self, shuffle):
+        indices = self._data_loader.get_session_indices()
+        if shuffle:
+            indices = np.random.permutation(indices)
+        for start in range(0, len(indices), self._block_size):
+            yield indices[start:start + self._block_size]
+
+    def _gather(self, indices):
+        return self._data_loader.gather(indices).astype(np.int32)
+
+    def _build(self, shuffle):
+        dataset = tf.data.Dataset.from_generator(
+            lambda: self._index_blocks(shuffle), tf.int64,
+            tf.TensorShape([None]))
+
+        def gather(indices):
+            sessions = tf.py_func(self._gather, [indices], tf.int32)
+            sessions.set_shape([None, self._max_length + 1, 5])
+            return sessions
+
+        dataset = dataset.map(gather,
+                              num_parallel_calls=self._num_parallel_calls)
+        dataset = dataset.flat_map(tf.data.Dataset.from_tensor_slices)
+        if shuffle:
+            dataset = dataset.shuffle(self._shuffle_buffer)
+        dataset = dataset.batch(self._batch_size)
+        dataset = dataset.map(_split_columns,
+                              num_parallel_calls=self._num_parallel_calls)
+        return dataset.prefetch(self._prefetch)
+
+    def initialize(self, sess, data_loader, shuffle=False):
+        self._data_loader = data_loader
+        sess.run(self._initializers[shuffle])
@@ -0,0 +1,96 @@
+import threading
+from queue import Queue
+from time import time
+
+import numpy as np
+
+
+def split_batch(batch_data):
+    """
+    Split a padded [batch, max_length + 1, 5] session batch into the
+    contiguous model inputs.
+    """
+    return {
+        'user': np.ascontiguousarray(batch_data[:, :-1, 0]),
+        'item': np.ascontiguousarray(batch_data[:, :-1, 1]),
+        'day_of_week': np.ascontiguousarray(batch_data[:, :-1, 3]),
+        'month_period': np.ascontiguousarray(batch_data[:, :-1, 4]),
+        'next_items': np.ascontiguousarray(batch_data[:, 1:, 1])
+    }
+
+
+class BatchPrefetcher(object):
+    """
+    Prepare split batches of a data loader in a background thread.
+    With depth = 0 batches are prepared synchronously by the caller.
+    """
+    _END = object()
+
+    def __init__(self, data_loader, depth=0):
+        self.data_loader = data_loader
+        self._depth = depth
+        self._queue = None
+        self._thread = None
+        self._stop = None
+        self._next = None
+
+        # Time spent waiting for the last batch and for the whole epoch
+        self.last_wait = 0.
+        self.epoch_wait = 0.
+
+    def _worker(self, queue, stop, shuffle):
+        try:
+            self.data_loader.next_epoch(shuffle=shuffle)
+            while self.data_loader.has_next() and not stop.is_set():
+                queue.put(split_batch(self.data_loader.next_batch()))
+            queue.put(self._END)
+        except Exception as e:
+            queue.put(e)
+
+    def _shutdown(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        while self._thread.is_alive():
+            while not self._queue.empty():
+                self._queue.get()
+            self._thread.join(0.1)
+        self._thread = None
+
+    def _fetch(self):
+        start = time()
+        if self._depth > 0:
+            columns = self._queue.get()
+            if isinstance(columns, Exception):
+                raise columns
+            if columns is self._END:
+                columns = None
+        elif self.data_loader.has_next():
+            columns = split_batch(self.data_loader.next_batch())
+        else:
+            columns = None
+        self.last_wait = time() - start
+        self.epoch_wait += self.last_wait
+        return columns
+
+    def next_epoch(self, shuffle=False):
+        self._shutdown()
+        self.epoch_wait = 0.
+        if self._depth > 0:
+            self._queue = Queue(maxsize=self._depth)
+            self._stop = threading.Event()
+            self._thread = threading.Thread(
+                target=self._worker, args=(self._queue, self._stop, shuffle))
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self.data_loader.next_epoch(shuffle=shuffle)
+        self._next = self._fetch()
+
+    def next_batch(self):
+        columns = self._next
+        self._next = self._fetch()
+        return columns
+
+    def has_next(self):
+        return self._next is not None
@@ -0,0 +1,162 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+COLUMNS = ['user', 'item', 'hour', 'day', 'month']
+_META_FILE = 'meta.json'
+_OFFSETS_FILE = 'offsets.bin'
+
+
+def get_store_path(path):
+    return path + '.store'
+
+
+class SessionStoreWriter(object):
+    """
+    Write sessions into a compiled columnar store.
+    Every column is a flat int32 file and session boundaries are kept in an
+    int64 offsets file, so the store can be memory-mapped without parsing.
+    """
+    def __init__(self, path, flush_every=1000000):
+        self._path = path
+        self._tmp_path = path + '.tmp'
+        self._flush_every = flush_every
+        self._buffer = []
+        self._buffer_lengths = []
+        self._buffer_events = 0
+        self._num_sessions = 0
+        self._num_events = 0
+
+        if os.path.exists(self._tmp_path):
+            shutil.rmtree(self._tmp_path)
+        os.makedirs(self._tmp_path)
+        self._files = {k: open(os.path.join(self._tmp_path, k + '.bin'), 'wb')
+                       for k in COLUMNS}
+        self._offsets = open(os.path.join(self._tmp_path, _OFFSETS_FILE), 'wb')
+        np.zeros(1, dtype=np.int64).tofile(self._offsets)
+
+    def add_session(self, events):
+        events = np.asarray(events, dtype=np.int32).reshape([-1, len(COLUMNS)])
+        self.add_sessions(events, [len(events)])
+
+    def add_sessions(self, events, lengths):
+        events = np.asarray(events, dtype=np.int32).reshape([-1, len(COLUMNS)])
+        lengths = np.asarray(lengths, dtype=np.int64)
+        assert lengths.sum() == len(events)
+        self._buffer.append(events)
+        self._buffer_lengths.append(lengths)
+        self._buffer_events += len(events)
+        if self._buffer_events >= self._flush_every:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        events = np.concatenate(self._buffer)
+        lengths = np.concatenate(self._buffer_lengths)
+        for i, k in enumerate(COLUMNS):
+            np.ascontiguousarray(events[:, i]).tofile(self._files[k])
+        (np.cumsum(lengths) + self._num_events).tofile(self._offsets)
+        self._num_sessions += len(lengths)
+        self._num_events += len(events)
+        self._buffer = []
+        self._buffer_lengths = []
+        self._buffer_events = 0
+
+    def close(self):
+        self._flush()
+        for f in self._files.values():
+            f.close()
+        self._offsets.close()
+        with open(os.path.join(self._tmp_path, _META_FILE), 'w') as f:
+            json.dump({'num_sessions': self._num_sessions,
+                       'num_events': self._num_events,
+                       'columns': COLUMNS}, f)
+        if os.path.exists(self._path):
+            shutil.rmtree(self._path)
+        os.rename(self._tmp_path, self._path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self._files.values():
+                f.close()
+            self._offsets.close()
+            shutil.rmtree(self._tmp_path)
+
+
+class SessionStore(object):
+    """
+    Read-only, memory-mapped view of a compiled session store.
+    """
+    def __init__(self, path):
+        self._path = path
+        with open(os.path.join(path, _META_FILE), 'r') as f:
+            meta = json.load(f)
+        self.num_sessions = meta['num_sessions']
+        self.num_events = meta['num_events']
+        self.offsets = np.memmap(os.path.join(path, _OFFSETS_FILE),
+                                 dtype=np.int64, mode='r')
+        self.columns = {}
+        for k in meta['columns']:
+            if self.num_events == 0:
+                self.columns[k] = np.zeros(0, dtype=np.int32)
+            else:
+                self.columns[k] = np.memmap(os.path.join(path, k + '.bin'),
+                                            dtype=np.int32, mode='r')
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, _META_FILE))
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def gather(self, indices, max_length):
+        """
+        Build a padded [len(indices), max_length + 1, 5] int32 batch
+        from the given session indices.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        if len(lengths) and lengths.max() > max_length + 1:
+            raise ValueError('Session longer than max_length + 1 in {}'
+                             .format(self._path))
+        total = int(lengths.sum())
+        rows = np.repeat(np.arange(len(indices)), lengths)
+        cols = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths,
+                                            lengths)
+        events = np.repeat(starts, lengths) + cols
+
+        batch = np.zeros([len(indices), max_length + 1, len(COLUMNS)],
+                         dtype=np.int32)
+        for i, k in enumerate(COLUMNS):
+            batch[rows, cols, i] = self.columns[k][events]
+        return batch
+
+
+def compile_session_store(text_path, store_path=None):
+    """
+    Convert a processed session text file (one `u,i,h,d,m` event per line,
+    sessions separated by `-----`) into a compiled session store.
+    """
+    if store_path is None:
+        store_path = get_store_path(text_path)
+    session = []
+    with SessionStoreWriter(store_path) as writer, open(text_path, 'r') as f:
+        for line in f:
+            if '-' in line:
+                writer.add_session(session)
+                session = []
+            else:
+                session.append([int(j) for j in line.strip().split(',')])
+    print('- {}: compiled to {}'.format(text_path, store_path))
+    return store_path
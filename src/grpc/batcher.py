@@ -0,0 +1,118 @@
+import threading
+from concurrent.futures import Future
+from queue import Empty, Queue
+from time import time
+
+
+class MicroBatcher(object):
+    """
+    Collect concurrent requests into batches for a single predict call.
+    A batch is dispatched once it holds max_batch_size requests or its
+    oldest request waited max_delay_ms. predict_fn receives the list of
+    request payloads and returns one result per payload.
+    """
+    def __init__(self, predict_fn, max_batch_size=32, max_delay_ms=2.):
+        self._predict_fn = predict_fn
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay_ms / 1000.
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._running = True
+        self._stopped = False
+
+        self.num_requests = 0
+        self.num_batches = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, payload):
+        future = Future()
+        # Under the lock of stop, nothing is queued behind the sentinel
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError('MicroBatcher is stopped')
+            self._queue.put((time(), payload, future))
+        return future
+
+    def predict(self, payload):
+        return self.submit(payload).result()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[0] + self._max_delay
+        while len(batch) < self._max_batch_size:
+            # Requests already queued join the batch even past the deadline
+            timeout = deadline - time()
+            try:
+                if timeout > 0:
+                    request = self._queue.get(timeout=timeout)
+                else:
+                    request = self._queue.get_nowait()
+            except Empty:
+                break
+            if request is None:
+                self._running = False
+                break
+            batch.append(request)
+        return batch
+
+    def _loop(self):
+        while self._running:
+            batch = self._collect()
+            if batch is None:
+                break
+            start = time()
+            waits = [start - enqueued for enqueued, _, _ in batch]
+            with self._lock:
+                self.num_requests += len(batch)
+                self.num_batches += 1
+                self.total_wait += sum(waits)
+                self.max_wait = max([self.max_wait] + waits)
+            try:
+                results = self._predict_fn([p for _, p, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+        self._drain()
+
+    def _drain(self):
+        # Fail the requests left behind the sentinel instead of leaving
+        # their handlers waiting
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except Empty:
+                return
+            if request is not None:
+                request[2].set_exception(
+                    RuntimeError('MicroBatcher is stopped'))
+
+    def stop(self):
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            num_requests = max(self.num_requests, 1)
+            return {
+                'requests': self.num_requests,
+                'batches': self.num_batches,
+                'avg_batch_size': float(self.num_requests) /
+                max(self.num_batches, 1),
+                'avg_queue_wait_ms': 1000. * self.total_wait / num_requests,
+                'max_queue_wait_ms': 1000. * self.max_wait
+            }
@@ -26,6 +26,21 @@ def call_GenerateRecommend(stub, events):
     return response
 
 
+def get_Session(events, k=0, exclude=()):
+    return resys_pb2.Session(events=list(generate_session(events)), k=k,
+                             exclude=exclude)
+
+
+def call_Recommend(stub, events, k=0, exclude=()):
+    return stub.Recommend(get_Session(events, k, exclude))
+
+
+def call_RecommendBatch(stub, sessions, k=0, exclude=()):
+    request = resys_pb2.SessionBatch(
+        sessions=[get_Session(events, k, exclude) for events in sessions])
+    return stub.RecommendBatch(request).results
+
+
 def run():
     events = [[1, 1, '2018-08-11 10:15:30'], [2, 1, '2018-11-16 10:15:30']]
     with grpc.insecure_channel('localhost:50051') as channel:
@@ -34,6 +49,12 @@ def run():
             it = stub.GenerateRecommend(generate_session(events))
             for r in it:
                 print(r.id)
+
+            r = call_Recommend(stub, events, k=5, exclude=[2])
+            print(list(zip(r.items, r.scores)))
+
+            for r in call_RecommendBatch(stub, [events, events[:1]], k=5):
+                print(list(zip(r.items, r.scores)))
         except Exception as e:
             print(e)
 
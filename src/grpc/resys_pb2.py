@@ -19,7 +19,7 @@ DESCRIPTOR = _descriptor.FileDescriptor(
   package='resys',
   syntax='proto3',
   serialized_options=_b('\n\007io.grpcB\nResysProtoP\001\242\002\002RS'),
-  serialized_pb=_b('\n\x0bresys.proto\x12\x05resys\"1\n\x05\x45vent\x12\x0c\n\x04user\x18\x01 \x01(\x05\x12\x0c\n\x04item\x18\x02 \x01(\x05\x12\x0c\n\x04\x64\x61te\x18\x03 \x01(\t\"\x12\n\x04Item\x12\n\n\x02id\x18\x01 \x01(\x05\x32=\n\x05Resys\x12\x34\n\x11GenerateRecommend\x12\x0c.resys.Event\x1a\x0b.resys.Item\"\x00(\x01\x30\x01\x42\x1c\n\x07io.grpcB\nResysProtoP\x01\xa2\x02\x02RSb\x06proto3')
+  serialized_pb=_b('\n\x0bresys.proto\x12\x05resys\"1\n\x05\x45vent\x12\x0c\n\x04user\x18\x01 \x01(\x05\x12\x0c\n\x04item\x18\x02 \x01(\x05\x12\x0c\n\x04\x64\x61te\x18\x03 \x01(\t\"\x12\n\x04Item\x12\n\n\x02id\x18\x01 \x01(\x05\"C\n\x07Session\x12\x1c\n\x06\x65vents\x18\x01 \x03(\x0b\x32\x0c.resys.Event\x12\t\n\x01k\x18\x02 \x01(\x05\x12\x0f\n\x07\x65xclude\x18\x03 \x03(\x05\"0\n\x0fRecommendations\x12\r\n\x05items\x18\x01 \x03(\x05\x12\x0e\n\x06scores\x18\x02 \x03(\x02\"0\n\x0cSessionBatch\x12 \n\x08sessions\x18\x01 \x03(\x0b\x32\x0e.resys.Session\"?\n\x14RecommendationsBatch\x12\'\n\x07results\x18\x01 \x03(\x0b\x32\x16.resys.Recommendations2\xba\x01\n\x05Resys\x12\x34\n\x11GenerateRecommend\x12\x0c.resys.Event\x1a\x0b.resys.Item\"\x00(\x01\x30\x01\x12\x35\n\tRecommend\x12\x0e.resys.Session\x1a\x16.resys.Recommendations\"\x00\x12\x44\n\x0eRecommendBatch\x12\x13.resys.SessionBatch\x1a\x1b.resys.RecommendationsBatch\"\x00\x42\x1c\n\x07io.grpcB\nResysProtoP\x01\xa2\x02\x02RSb\x06proto3')
 )
 
 
@@ -100,8 +100,160 @@ _ITEM = _descriptor.Descriptor(
   serialized_end=91,
 )
 
+
+_SESSION = _descriptor.Descriptor(
+  name='Session',
+  full_name='resys.Session',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='events', full_name='resys.Session.events', index=0,
+      number=1, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='k', full_name='resys.Session.k', index=1,
+      number=2, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='exclude', full_name='resys.Session.exclude', index=2,
+      number=3, type=5, cpp_type=1, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=93,
+  serialized_end=160,
+)
+
+
+_RECOMMENDATIONS = _descriptor.Descriptor(
+  name='Recommendations',
+  full_name='resys.Recommendations',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='items', full_name='resys.Recommendations.items', index=0,
+      number=1, type=5, cpp_type=1, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='scores', full_name='resys.Recommendations.scores', index=1,
+      number=2, type=2, cpp_type=6, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=162,
+  serialized_end=210,
+)
+
+
+_SESSIONBATCH = _descriptor.Descriptor(
+  name='SessionBatch',
+  full_name='resys.SessionBatch',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='sessions', full_name='resys.SessionBatch.sessions', index=0,
+      number=1, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=212,
+  serialized_end=260,
+)
+
+
+_RECOMMENDATIONSBATCH = _descriptor.Descriptor(
+  name='RecommendationsBatch',
+  full_name='resys.RecommendationsBatch',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='results', full_name='resys.RecommendationsBatch.results', index=0,
+      number=1, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=262,
+  serialized_end=325,
+)
+
+_SESSION.fields_by_name['events'].message_type = _EVENT
+_SESSIONBATCH.fields_by_name['sessions'].message_type = _SESSION
+_RECOMMENDATIONSBATCH.fields_by_name['results'].message_type = _RECOMMENDATIONS
 DESCRIPTOR.message_types_by_name['Event'] = _EVENT
 DESCRIPTOR.message_types_by_name['Item'] = _ITEM
+DESCRIPTOR.message_types_by_name['Session'] = _SESSION
+DESCRIPTOR.message_types_by_name['Recommendations'] = _RECOMMENDATIONS
+DESCRIPTOR.message_types_by_name['SessionBatch'] = _SESSIONBATCH
+DESCRIPTOR.message_types_by_name['RecommendationsBatch'] = _RECOMMENDATIONSBATCH
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
 
 Event = _reflection.GeneratedProtocolMessageType('Event', (_message.Message,), dict(
@@ -118,6 +270,34 @@ Item = _reflection.GeneratedProtocolMessageType('Item', (_message.Message,), dic
   ))
 _sym_db.RegisterMessage(Item)
 
+Session = _reflection.GeneratedProtocolMessageType('Session', (_message.Message,), dict(
+  DESCRIPTOR = _SESSION,
+  __module__ = 'resys_pb2'
+  # @@protoc_insertion_point(class_scope:resys.Session)
+  ))
+_sym_db.RegisterMessage(Session)
+
+Recommendations = _reflection.GeneratedProtocolMessageType('Recommendations', (_message.Message,), dict(
+  DESCRIPTOR = _RECOMMENDATIONS,
+  __module__ = 'resys_pb2'
+  # @@protoc_insertion_point(class_scope:resys.Recommendations)
+  ))
+_sym_db.RegisterMessage(Recommendations)
+
+SessionBatch = _reflection.GeneratedProtocolMessageType('SessionBatch', (_message.Message,), dict(
+  DESCRIPTOR = _SESSIONBATCH,
+  __module__ = 'resys_pb2'
+  # @@protoc_insertion_point(class_scope:resys.SessionBatch)
+  ))
+_sym_db.RegisterMessage(SessionBatch)
+
+RecommendationsBatch = _reflection.GeneratedProtocolMessageType('RecommendationsBatch', (_message.Message,), dict(
+  DESCRIPTOR = _RECOMMENDATIONSBATCH,
+  __module__ = 'resys_pb2'
+  # @@protoc_insertion_point(class_scope:resys.RecommendationsBatch)
+  ))
+_sym_db.RegisterMessage(RecommendationsBatch)
+
 
 DESCRIPTOR._options = None
 
@@ -127,8 +307,8 @@ _RESYS = _descriptor.ServiceDescriptor(
   file=DESCRIPTOR,
   index=0,
   serialized_options=None,
-  serialized_start=93,
-  serialized_end=154,
+  serialized_start=328,
+  serialized_end=514,
   methods=[
   _descriptor.MethodDescriptor(
     name='GenerateRecommend',
@@ -139,6 +319,24 @@ _RESYS = _descriptor.ServiceDescriptor(
     output_type=_ITEM,
     serialized_options=None,
   ),
+  _descriptor.MethodDescriptor(
+    name='Recommend',
+    full_name='resys.Resys.Recommend',
+    index=1,
+    containing_service=None,
+    input_type=_SESSION,
+    output_type=_RECOMMENDATIONS,
+    serialized_options=None,
+  ),
+  _descriptor.MethodDescriptor(
+    name='RecommendBatch',
+    full_name='resys.Resys.RecommendBatch',
+    index=2,
+    containing_service=None,
+    input_type=_SESSIONBATCH,
+    output_type=_RECOMMENDATIONSBATCH,
+    serialized_options=None,
+  ),
 ])
 _sym_db.RegisterServiceDescriptor(_RESYS)
 
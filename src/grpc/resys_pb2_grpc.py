@@ -19,6 +19,16 @@ class ResysStub(object):
         request_serializer=resys__pb2.Event.SerializeToString,
         response_deserializer=resys__pb2.Item.FromString,
         )
+    self.Recommend = channel.unary_unary(
+        '/resys.Resys/Recommend',
+        request_serializer=resys__pb2.Session.SerializeToString,
+        response_deserializer=resys__pb2.Recommendations.FromString,
+        )
+    self.RecommendBatch = channel.unary_unary(
+        '/resys.Resys/RecommendBatch',
+        request_serializer=resys__pb2.SessionBatch.SerializeToString,
+        response_deserializer=resys__pb2.RecommendationsBatch.FromString,
+        )
 
 
 class ResysServicer(object):
@@ -32,6 +42,20 @@ class ResysServicer(object):
     context.set_details('Method not implemented!')
     raise NotImplementedError('Method not implemented!')
 
+  def Recommend(self, request, context):
+    # missing associated documentation comment in .proto file
+    pass
+    context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+    context.set_details('Method not implemented!')
+    raise NotImplementedError('Method not implemented!')
+
+  def RecommendBatch(self, request, context):
+    # missing associated documentation comment in .proto file
+    pass
+    context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+    context.set_details('Method not implemented!')
+    raise NotImplementedError('Method not implemented!')
+
 
 def add_ResysServicer_to_server(servicer, server):
   rpc_method_handlers = {
@@ -40,6 +64,16 @@ def add_ResysServicer_to_server(servicer, server):
           request_deserializer=resys__pb2.Event.FromString,
           response_serializer=resys__pb2.Item.SerializeToString,
       ),
+      'Recommend': grpc.unary_unary_rpc_method_handler(
+          servicer.Recommend,
+          request_deserializer=resys__pb2.Session.FromString,
+          response_serializer=resys__pb2.Recommendations.SerializeToString,
+      ),
+      'RecommendBatch': grpc.unary_unary_rpc_method_handler(
+          servicer.RecommendBatch,
+          request_deserializer=resys__pb2.SessionBatch.FromString,
+          response_serializer=resys__pb2.RecommendationsBatch.SerializeToString,
+      ),
   }
   generic_handler = grpc.method_handlers_generic_handler(
       'resys.Resys', rpc_method_handlers)
@@ -3,9 +3,11 @@ sys.path.append('../..')  # noqa
 
 import time
 import os
+import signal
+import asyncio
+import multiprocessing
 import grpc
 import argparse
-import tensorflow as tf
 import numpy as np
 
 from concurrent import futures
@@ -15,51 +17,349 @@ import resys_pb2_grpc
 
 from src.utils.qpath import CHECKPOINT_DIR
 from src.utils.config import Args
-from src.main.main import _parse_cmd, get_tensorflow_session
+from src.main.main import _parse_cmd
 from src.trainers.UserGru_predict import UserGruPredict
-from src.models.UserGru import UserGruModel
-from src.data.preprocess import extract_time_context_raw
+from src.models.numpy_engine import NumpyUserGru
+from src.data.preprocess import extract_time_context_raw_batch
+from src.grpc.batcher import MicroBatcher
+from src.grpc.session_cache import SessionCache
+from src.utils.weights import SHARED_WEIGHTS, export_weights, \
+    get_export_dir, is_stale, load_weights
 
 
 _ONE_DAY_IN_SECONDS = 60 * 60 * 24
 
 
+def get_rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.
+    return 0.
+
+
 class ResysServicer(resys_pb2_grpc.ResysServicer):
     def __init__(self, config):
-        model = UserGruModel(config)
-        sess = get_tensorflow_session()
+        start = time.time()
+        checkpoint = CHECKPOINT_DIR + config.name + '.ckpt'
+        sess = None
+        # TF is only imported by the graph engines, the NumPy engine
+        # serves without it
+        if config.engine == 'numpy':
+            model = NumpyUserGru.from_export(config, get_shared_export(
+                checkpoint, config.quantize, config.engine))
+        elif config.frozen:
+            from src.models.frozen import FrozenModel, get_frozen_path
+
+            model = FrozenModel(get_frozen_path(checkpoint))
+        else:
+            from src.models.UserGru import UserGruModel
+
+            if config.quantize and config.shared_weights is None:
+                config.shared_weights = load_weights(
+                    get_shared_export(checkpoint, config.quantize),
+                    SHARED_WEIGHTS)
+            config.inference_only = 1
+            model = UserGruModel(config)
+        if config.engine != 'numpy':
+            from src.main.main import get_tensorflow_session
+
+            sess = get_tensorflow_session()
+        self.config = config
         self.resys = UserGruPredict(sess, model, config)
-        self.resys.load(CHECKPOINT_DIR + config.name + '.ckpt')
+        self.resys.load(checkpoint)
+        print('Startup: {:.2f}s  -  RSS: {:.1f}MB'.format(
+            time.time() - start, get_rss_mb()))
+        self.sessions = SessionCache(
+            config.cache_mb * 1024 * 1024, ttl=config.cache_ttl,
+            max_events=config.max_length)
+        self._num_requests = 0
+        self._request_time = 0.
+
+        self.batcher = None
+        if config.max_batch_size > 1:
+            self.batcher = MicroBatcher(
+                self.predict_batch, max_batch_size=config.max_batch_size,
+                max_delay_ms=config.max_delay_ms)
+
+    def predict_batch(self, requests):
+        if self.config.step_inference:
+            return self.resys.run_step_batch(requests)
+        sessions = np.array([s for s, _, _ in requests], dtype=np.int32)
+        return self.resys.run_predict_batch(
+            sessions, [p for _, p, _ in requests], [o for _, _, o in requests])
+
+    def close(self):
+        if self.batcher is not None:
+            self.batcher.stop()
+
+    def predict_step(self, event, state, option):
+        return self.batcher.predict((event, state, option))
+
+    def log_stats(self, elapsed):
+        self._num_requests += 1
+        self._request_time += elapsed
+        if self._num_requests % self.config.display_every == 0:
+            print('Requests: {}  -  Avg latency: {:.3f}ms'.format(
+                self._num_requests,
+                1000. * self._request_time / self._num_requests))
+            if self.config.step_inference:
+                print('Session cache: ', self.sessions.stats())
+            if self.batcher is not None:
+                print('Micro-batching: ', self.batcher.stats())
+
+    def get_padded_session(self, events):
+        length = self.config.max_length + 1
+        pos = len(events) - 1
+        events = events + [[1, 1, 0, 0]]
+        if len(events) >= length:
+            events = events[-length:]
+            pos = length - 2
+        else:
+            events = events + [[0, 0, 0, 0]] * (length - len(events))
+        return np.array(events, dtype=np.int32), pos
 
     def get_items_iterator(self, items):
         for i in items:
             yield resys_pb2.Item(id=i)
 
+    @staticmethod
+    def get_events(request_events):
+        # The streaming RPC passes a one-shot iterator, read it once
+        request_events = list(request_events)
+        days, half_months = extract_time_context_raw_batch(
+            [event.date for event in request_events])
+        return [[event.user, event.item, day, half_month]
+                for event, day, half_month in zip(
+                    request_events, days.tolist(), half_months.tolist())]
+
+    def get_option(self, session):
+        """
+        (k, exclude) of a Session message, k is capped at max_k.
+        """
+        k = session.k if session.k > 0 else self.config.top_k
+        return min(k, self.config.max_k), list(session.exclude)
+
+    @staticmethod
+    def filter_recommendations(rec_items, k, exclude):
+        """
+        First k recommendations that are not excluded.
+        """
+        exclude = set(exclude)
+        kept = [(i, s) for i, s in zip(*rec_items) if i not in exclude][:k]
+        return [i for i, _ in kept], [s for _, s in kept]
+
+    @staticmethod
+    def get_new_events(cached, events):
+        """
+        Events of a request that are not covered by the cached session.
+        Clients may resend the whole history or only the newest events.
+        """
+        steps, tail = cached.steps, cached.events
+        if len(events) >= steps and \
+                events[steps - len(tail):steps] == tail:
+            return events[steps:]
+        for k in range(min(len(tail), len(events)), 0, -1):
+            if events[:k] == tail[-k:]:
+                return events[k:]
+        return events
+
+    def recommend_step(self, events, option):
+        """
+        Recommend with the step-wise model, only feeding the events that
+        were not processed by a previous request of the same user.
+        The cache keeps k + len(exclude) unfiltered candidates so that a
+        repeated request with other options rarely needs the model.
+        """
+        k, exclude = option
+        max_length = self.config.max_length
+        user = events[-1][0]
+        cached = self.sessions.get(user)
+        if cached is not None:
+            new_events = self.get_new_events(cached, events)
+            offset, state = cached.steps, cached.state
+            history = cached.events + new_events
+            if not new_events:
+                rec = self.filter_recommendations(cached.rec_items, k,
+                                                  exclude)
+                if len(rec[0]) == k:
+                    return rec
+                # Replay the events since the last state reset
+                offset = (cached.steps - 1) // max_length * max_length
+                new_events = cached.events[offset - cached.steps:]
+                state, history = None, cached.events
+        else:
+            offset = (len(events) - 1) // max_length * max_length
+            new_events, state = events[offset:], None
+            history = events
+        step_fn = self.predict_step if self.batcher is not None else None
+        rec_items, state = self.resys.run_session_steps(
+            new_events, state, offset, step_fn, (k + len(exclude), ()))
+        self.sessions.put(user, history, offset + len(new_events), state,
+                          rec_items)
+        return self.filter_recommendations(rec_items, k, exclude)
+
+    def recommend(self, events, option):
+        """
+        Top items and scores of one session.
+        :param events: list of (user, item, day, half month)
+        :param option: (k, exclude)
+        """
+        if self.config.step_inference:
+            return self.recommend_step(events, option)
+        session, pos = self.get_padded_session(events)
+        if self.batcher is not None:
+            return self.batcher.predict((session, pos, option))
+        return self.resys.run_predict_batch(session[None], [pos], [option])[0]
+
+    def recommend_batch(self, sessions, options):
+        """
+        Recommend for several sessions. Without step-wise inference the
+        sessions are scored by a single predict call.
+        """
+        if self.config.step_inference:
+            return [self.recommend_step(e, o)
+                    for e, o in zip(sessions, options)]
+        padded = [self.get_padded_session(events) for events in sessions]
+        return self.resys.run_predict_batch(
+            np.array([s for s, _ in padded], dtype=np.int32),
+            [p for _, p in padded], options)
+
     def GenerateRecommend(self, request_iterator, context):
-        events = []
+        start = time.time()
         try:
-            for event in request_iterator:
-                day, half_month = extract_time_context_raw(event.date)
-                events.append([event.user, event.item, day, half_month])
-
-            pos = len(events) - 1
-            events.append([1, 1, 0, 0])
-            if len(events) >= 11:
-                events = events[-11:]
-                pos = 9
-            else:
-                tmp = len(events)
-                for i in range(11 - tmp):
-                    events.append([0, 0, 0, 0])
-
-            # print(events)
-            events = [events]
-            events = np.array(events)
-            rec_items = self.resys.run_predict(events, pos)
+            events = self.get_events(request_iterator)
+            rec_items, _ = self.recommend(events, (self.config.top_k, []))
+            self.log_stats(time.time() - start)
             return self.get_items_iterator(rec_items)
         except Exception as e:
             print(e)
 
+    def Recommend(self, request, context):
+        start = time.time()
+        if not request.events:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('Session without events')
+            return resys_pb2.Recommendations()
+        try:
+            items, scores = self.recommend(self.get_events(request.events),
+                                           self.get_option(request))
+            self.log_stats(time.time() - start)
+            return resys_pb2.Recommendations(items=items, scores=scores)
+        except Exception as e:
+            print(e)
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(str(e))
+            return resys_pb2.Recommendations()
+
+    def RecommendBatch(self, request, context):
+        start = time.time()
+        if not all(session.events for session in request.sessions):
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details('Session without events')
+            return resys_pb2.RecommendationsBatch()
+        try:
+            results = self.recommend_batch(
+                [self.get_events(s.events) for s in request.sessions],
+                [self.get_option(s) for s in request.sessions])
+            self.log_stats(time.time() - start)
+            return resys_pb2.RecommendationsBatch(results=[
+                resys_pb2.Recommendations(items=items, scores=scores)
+                for items, scores in results])
+        except Exception as e:
+            print(e)
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(str(e))
+            return resys_pb2.RecommendationsBatch()
+
+
+class AsyncResysServicer(resys_pb2_grpc.ResysServicer):
+    """
+    grpc.aio front end of ResysServicer. Messages are decoded on the event
+    loop and the model runs on a dedicated executor (or the micro-batcher
+    thread), so idle or slow client streams do not hold a thread.
+    At most max_pending requests wait for the model, further requests are
+    rejected with RESOURCE_EXHAUSTED.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.servicer = ResysServicer(config)
+        self.executor = futures.ThreadPoolExecutor(
+            max_workers=config.inference_threads)
+        self.num_pending = 0
+        self.num_rejected = 0
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.servicer.close()
+        print('Rejected requests: ', self.num_rejected)
+
+    async def wait_model(self, context, submit):
+        """
+        Await the concurrent future returned by submit().
+        """
+        if self.num_pending >= self.config.max_pending:
+            self.num_rejected += 1
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                                'Too many pending requests')
+        # The counter is only touched from the event loop thread
+        self.num_pending += 1
+        try:
+            return await asyncio.wrap_future(submit())
+        finally:
+            self.num_pending -= 1
+
+    def run_model(self, context, fn, *args):
+        return self.wait_model(
+            context, lambda: self.executor.submit(fn, *args))
+
+    async def recommend(self, context, events, option):
+        servicer = self.servicer
+        if servicer.batcher is None or self.config.step_inference:
+            return await self.run_model(context, servicer.recommend,
+                                        events, option)
+        # The micro-batcher already owns a thread, only wait on its future
+        session, pos = servicer.get_padded_session(events)
+        return await self.wait_model(
+            context, lambda: servicer.batcher.submit((session, pos, option)))
+
+    async def GenerateRecommend(self, request_iterator, context):
+        start = time.time()
+        events = []
+        async for event in request_iterator:
+            events.append(event)
+        rec_items, _ = await self.recommend(
+            context, self.servicer.get_events(events),
+            (self.config.top_k, []))
+        self.servicer.log_stats(time.time() - start)
+        for i in rec_items:
+            yield resys_pb2.Item(id=i)
+
+    async def Recommend(self, request, context):
+        start = time.time()
+        if not request.events:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                'Session without events')
+        items, scores = await self.recommend(
+            context, self.servicer.get_events(request.events),
+            self.servicer.get_option(request))
+        self.servicer.log_stats(time.time() - start)
+        return resys_pb2.Recommendations(items=items, scores=scores)
+
+    async def RecommendBatch(self, request, context):
+        start = time.time()
+        if not all(session.events for session in request.sessions):
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                'Session without events')
+        results = await self.run_model(
+            context, self.servicer.recommend_batch,
+            [self.servicer.get_events(s.events) for s in request.sessions],
+            [self.servicer.get_option(s) for s in request.sessions])
+        self.servicer.log_stats(time.time() - start)
+        return resys_pb2.RecommendationsBatch(results=[
+            resys_pb2.Recommendations(items=items, scores=scores)
+            for items, scores in results])
+
 
 def start(server, config):
     resys_pb2_grpc.add_ResysServicer_to_server(
@@ -69,14 +369,97 @@ def start(server, config):
     print('Service start')
 
 
-def serve(config):
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+def serve(config, options=None):
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=10), options=options,
+        maximum_concurrent_rpcs=config.max_concurrent_rpcs or None)
     start(server, config)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     try:
         while True:
             time.sleep(_ONE_DAY_IN_SECONDS)
     except KeyboardInterrupt:
-        server.stop(0)
+        server.stop(config.grace_period).wait()
+
+
+async def serve_aio(config, options=None):
+    """
+    Serve with grpc.aio until SIGINT or SIGTERM, then stop accepting
+    requests and let in-flight ones finish within grace_period seconds.
+    """
+    server = grpc.aio.server(
+        options=options,
+        maximum_concurrent_rpcs=config.max_concurrent_rpcs or None)
+    servicer = AsyncResysServicer(config)
+    resys_pb2_grpc.add_ResysServicer_to_server(servicer, server)
+    server.add_insecure_port('[::]:50051')
+    await server.start()
+    print('Service start (aio)')
+
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    print('Draining requests')
+    await server.stop(config.grace_period)
+    servicer.close()
+
+
+def get_shared_export(checkpoint, quantize=None, engine='tf'):
+    """
+    :param engine: 'numpy' fails on a missing or stale export instead of
+                   writing it, which would import TF
+    """
+    export_dir = get_export_dir(checkpoint, quantize)
+    if is_stale(checkpoint, export_dir):
+        if engine == 'numpy':
+            raise IOError('The NumPy engine serves from a weight export, '
+                          '{} is missing or older than the checkpoint: run '
+                          '--mode export first'.format(export_dir))
+        export_weights(checkpoint, export_dir, quantize=quantize)
+    return export_dir
+
+
+def _serve_worker(config, export_dir):
+    config.shared_weights = load_weights(export_dir, SHARED_WEIGHTS)
+    options = [('grpc.so_reuseport', 1)]
+    if config.server_mode == 'aio':
+        asyncio.get_event_loop().run_until_complete(
+            serve_aio(config, options))
+    else:
+        serve(config, options)
+
+
+def serve_prefork(config):
+    """
+    Run num_servers server processes bound to the same port with
+    SO_REUSEPORT, the kernel spreads connections over them. The matrices
+    that grow with the catalogue are exported once next to the checkpoint
+    and memory-mapped read-only by every worker, so the page cache holds a
+    single copy; each worker restores the rest from the checkpoint.
+    """
+    export_dir = get_shared_export(CHECKPOINT_DIR + config.name + '.ckpt',
+                                   config.quantize, config.engine)
+
+    # Workers are spawned, neither TF nor gRPC state survives a fork
+    ctx = multiprocessing.get_context('spawn')
+    workers = [ctx.Process(target=_serve_worker, args=(config, export_dir))
+               for _ in range(config.num_servers)]
+    for worker in workers:
+        worker.start()
+    print('Started {} server processes'.format(len(workers)))
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
 
 
 def main():
@@ -85,7 +468,12 @@ def main():
     # args.name = 'UserAGru-context-best'
     args.load_model_config()
 
-    serve(args)
+    if args.num_servers > 1:
+        serve_prefork(args)
+    elif args.server_mode == 'aio':
+        asyncio.get_event_loop().run_until_complete(serve_aio(args))
+    else:
+        serve(args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+
+# Fixed per-entry overhead of the dict, tuple and list objects (bytes)
+_ENTRY_OVERHEAD = 512
+_EVENT_SIZE = 4 * 8
+
+CacheEntry = namedtuple('CacheEntry',
+                        ['events', 'steps', 'state', 'rec_items', 'nbytes'])
+
+
+def _state_nbytes(state):
+    if isinstance(state, np.ndarray):
+        return state.nbytes
+    if isinstance(state, (tuple, list)):
+        return sum(_state_nbytes(s) for s in state)
+    return 0
+
+
+class SessionCache(object):
+    """
+    Bounded cache of the recurrent state of live sessions.
+    Every entry keeps the last events of a user, the number of steps
+    processed in the session, the recurrent state and the last
+    recommendation as (items, scores). Entries are evicted in LRU order
+    once the memory budget is exceeded and expire after `ttl` seconds
+    without activity, the same gap that splits sessions in preprocessing.
+    """
+    def __init__(self, max_bytes, ttl=3600, max_events=10, clock=time.time):
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._max_events = max_events
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._last_access = {}
+        self._lock = threading.Lock()
+        self._nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        del self._last_access[key]
+        self._nbytes -= entry.nbytes
+
+    def _expire(self, now):
+        # Entries are kept in access order, expired ones are at the front
+        while self._entries:
+            key = next(iter(self._entries))
+            if now - self._last_access[key] <= self._ttl:
+                break
+            self._remove(key)
+            self.expirations += 1
+
+    def get(self, key):
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._last_access[key] = now
+            self.hits += 1
+            return entry
+
+    def put(self, key, events, steps, state, rec_items):
+        events = [list(e) for e in events[-self._max_events:]]
+        nbytes = _ENTRY_OVERHEAD + _state_nbytes(state) + \
+            len(events) * _EVENT_SIZE + len(rec_items[0]) * 16
+        entry = CacheEntry(events, steps, state, rec_items, nbytes)
+        with self._lock:
+            now = self._clock()
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._last_access[key] = now
+            self._nbytes += nbytes
+            self._expire(now)
+            while self._nbytes > self._max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
@@ -2,24 +2,35 @@ import sys
 sys.path.append('../..')  # noqa
 
 import argparse
-import tensorflow as tf
-from tensorflow.python.client import device_lib
+import copy
+import numpy as np
 
-from src.data_loader.data_loader import DataLoader
-from src.models.UserGru import UserGruModel
-from src.trainers.UserGru_evaluator import UserGruEval
-from src.trainers.UserGru_trainer import UserGruTrainer
+from src.data_loader.data_loader import DataLoader, get_data_loader
+from src.data_loader.prefetcher import split_batch
+from src.trainers.UserGru_parallel_evaluator import run_parallel_evaluation
 from src.utils.config import Args
+from src.utils.item_index import ItemIndex, get_index_path
+from src.utils.quantization import QUANTIZATION_MODES
+from src.utils.weights import QUANTIZED_WEIGHTS, export_weights, \
+    get_export_dir, is_model_variable, is_stale, load_weights
 from src.utils.qpath import *
 
 
+# TF and the modules built on it are imported by the modes that use them,
+# so that importing _parse_cmd (e.g. from the server) does not load TF
+
+
 def get_available_gpus():
+    from tensorflow.python.client import device_lib
+
     local_device_protos = device_lib.list_local_devices()
     print([x.name for x in local_device_protos if x.device_type == 'GPU'])
     return [x.name for x in local_device_protos if x.device_type == 'GPU']
 
 
 def get_tensorflow_session():
+    import tensorflow as tf
+
     config = tf.ConfigProto(device_count={'GPU': 1})
     config.gpu_options.allow_growth = True
     return tf.Session(config=config)
@@ -28,7 +39,8 @@ def get_tensorflow_session():
 def _parse_cmd():
     parser = argparse.ArgumentParser()
     # Running mode
-    parser.add_argument('--mode', choices=['train', 'test'],
+    parser.add_argument('--mode', choices=['train', 'test', 'index',
+                                           'export', 'quantize', 'parity'],
                         default='train')
     parser.add_argument("--name", type=str, default='baseline')
     parser.add_argument('--combination', choices=[
@@ -41,6 +53,23 @@ def _parse_cmd():
     parser.add_argument('--train_file', type=str, default='clean-avito-train')
     parser.add_argument('--test_file', type=str, default='clean-avito-test')
 
+    # Data loading
+    parser.add_argument('--streaming', type=int, default=0,
+                        help='Stream batches from the compiled session store')
+    parser.add_argument('--block_size', type=int, default=10000,
+                        help='Sessions per block read in streaming and '
+                        'dataset modes')
+    parser.add_argument('--shuffle_buffer', type=int, default=10000,
+                        help='Sessions kept in the streaming shuffle buffer')
+    parser.add_argument('--prefetch_depth', type=int, default=2,
+                        help='Batches prepared ahead in a background thread '
+                        '(0 to disable)')
+    parser.add_argument('--input_mode', choices=['placeholder', 'dataset'],
+                        default='placeholder',
+                        help='Feed batches through placeholders or read '
+                        'them from an in-graph tf.data pipeline')
+    parser.add_argument('--num_parallel_calls', type=int, default=4)
+
     # Hyper params
     parser.add_argument('--cell', choices=['lstm', 'gru', 'rnn'],
                         default='gru')
@@ -54,6 +83,75 @@ def _parse_cmd():
     parser.add_argument('--keep_pr', type=float, default=0.25)
     parser.add_argument('--num_epoch', type=int, default=20)
     parser.add_argument('--batch_size', type=int, default=50)
+    parser.add_argument('--loss',
+                        choices=['softmax', 'sampled_softmax', 'nce'],
+                        default='softmax',
+                        help='Training objective. Evaluation always uses the '
+                        'full softmax')
+    parser.add_argument('--num_sampled', type=int, default=100,
+                        help='Negative items sampled per target')
+    parser.add_argument('--sampling_distortion', type=float, default=0.75,
+                        help='Exponent applied to item popularity when '
+                        'sampling negatives')
+
+    # Evaluation
+    parser.add_argument('--cutoffs', type=int, nargs='+', default=[5, 20],
+                        help='Cutoffs k of the reported Recall@k and MRR@k')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='Worker processes for sharded test evaluation')
+
+    # Serving
+    parser.add_argument('--step_inference', type=int, default=0,
+                        help='Serve with the single-step model and keep the '
+                        'recurrent state of every user')
+    parser.add_argument('--cache_mb', type=int, default=256,
+                        help='Memory budget of the session state cache')
+    parser.add_argument('--cache_ttl', type=int, default=3600,
+                        help='Seconds of inactivity before a cached session '
+                        'expires (the preprocessing time_interval)')
+    parser.add_argument('--max_batch_size', type=int, default=32,
+                        help='Requests merged into one inference batch '
+                        '(1 to disable micro-batching)')
+    parser.add_argument('--max_delay_ms', type=float, default=2.,
+                        help='Longest time a request waits for its batch')
+    parser.add_argument('--top_k', type=int, default=10,
+                        help='Recommended items when a request sets no k')
+    parser.add_argument('--max_k', type=int, default=100,
+                        help='Largest k a request may ask for')
+    parser.add_argument('--server_mode', choices=['sync', 'aio'],
+                        default='sync',
+                        help='Thread pool gRPC server or grpc.aio server')
+    parser.add_argument('--inference_threads', type=int, default=4,
+                        help='Executor threads running the model (aio)')
+    parser.add_argument('--max_pending', type=int, default=256,
+                        help='Requests waiting for the model before new ones '
+                        'are rejected (aio)')
+    parser.add_argument('--max_concurrent_rpcs', type=int, default=0,
+                        help='Open RPCs accepted by the server (0: no limit)')
+    parser.add_argument('--grace_period', type=float, default=10.,
+                        help='Seconds given to in-flight requests on shutdown')
+    parser.add_argument('--retrieval', type=int, default=0,
+                        help='Search top items in the clustered item index '
+                        'built by --mode index')
+    parser.add_argument('--nprobe', type=int, default=8,
+                        help='Clusters of the item index searched per query')
+    parser.add_argument('--num_clusters', type=int, default=0,
+                        help='Clusters of the item index '
+                        '(0: 4 * sqrt(num_items))')
+    parser.add_argument('--num_queries', type=int, default=10000,
+                        help='Test events used to measure the index recall')
+    parser.add_argument('--num_servers', type=int, default=1,
+                        help='Server processes sharing the port, with the '
+                        'large matrices memory-mapped from one export')
+    parser.add_argument('--frozen', type=int, default=0,
+                        help='Serve the frozen graph written by --mode export')
+    parser.add_argument('--quantize', choices=['none', 'float16', 'int8'],
+                        default='none',
+                        help='Serve the item embeddings and output layer '
+                        'quantized')
+    parser.add_argument('--engine', choices=['tf', 'numpy'], default='tf',
+                        help='Serve with the TF graph or the NumPy engine, '
+                        'which needs the weights written by --mode export')
 
     # Logging & Summary
     parser.add_argument('--display_every', type=int, default=500)
@@ -64,10 +162,15 @@ def _parse_cmd():
 
 
 def run_training(args):
+    from src.models.UserGru import UserGruModel
+    from src.trainers.UserGru_trainer import UserGruTrainer
+
     sess = get_tensorflow_session()
+    train_loader = get_data_loader(args.train_path, args)
+    if args.loss != 'softmax':
+        args.item_counts = train_loader.get_item_counts(args.num_items)
     model = UserGruModel(args)
 
-    train_loader = DataLoader(args.train_path, args)
     trainer = UserGruTrainer(sess, model, args, train_loader)
 
     if os.path.exists(CHECKPOINT_DIR + args.name + '.ckpt.index') and \
@@ -81,18 +184,242 @@ def run_training(args):
 
 def run_evaluation(args):
     args.load_model_config()
-    sess = get_tensorflow_session()
-    model = UserGruModel(args)
+    checkpoint = CHECKPOINT_DIR + args.name + '.ckpt'
+    if args.num_workers > 1:
+        acc, mrr = run_parallel_evaluation(args, checkpoint, args.num_workers)
+    else:
+        from src.models.UserGru import UserGruModel
+        from src.trainers.UserGru_evaluator import UserGruEval
+
+        sess = get_tensorflow_session()
+        model = UserGruModel(args)
 
-    test_loader = DataLoader(args.test_path, args)
-    evaluator = UserGruEval(sess, model, args, test_loader)
-    evaluator.load(CHECKPOINT_DIR + args.name + '.ckpt')
-    acc, mrr = evaluator.run_evaluation()
+        test_loader = get_data_loader(args.test_path, args)
+        evaluator = UserGruEval(sess, model, args, test_loader)
+        evaluator.load(checkpoint)
+        acc, mrr = evaluator.run_evaluation()
+        print('Data wait: {:.5f}s  -  Compute: {:.5f}s'.format(
+            evaluator.batches.epoch_wait, evaluator.compute_time))
     print('++ Evaluate result on test set ++')
-    for k, r, m in zip([5, 20], acc, mrr):
+    for k, r, m in zip(args.cutoffs, acc, mrr):
         print('Recall@{}: {}  -  MRR@{}: {}'.format(k, r, k, m))
 
 
+def run_export(args):
+    """
+    Export the frozen inference graph of a trained model, with the step
+    model if --step_inference is set, and its weights for the NumPy engine,
+    quantized if --quantize is set.
+    """
+    import tensorflow as tf
+    from src.models.UserGru import UserGruModel
+    from src.models.frozen import export_frozen_graph, get_frozen_path
+
+    args.load_model_config()
+    args.streaming = 0
+    args.input_mode = 'placeholder'
+    args.inference_only = 1
+    checkpoint = CHECKPOINT_DIR + args.name + '.ckpt'
+    sess = get_tensorflow_session()
+    model = UserGruModel(args)
+    if args.step_inference:
+        model.build_step_model()
+    tf.train.Saver().restore(sess, checkpoint)
+    export_frozen_graph(sess, model, get_frozen_path(checkpoint))
+    export_weights(checkpoint, quantize=args.quantize)
+
+
+def run_quantization(args):
+    """
+    Export the quantized weights for serving and compare Recall/MRR of
+    every quantization mode against the float32 model on the test set.
+    """
+    import tensorflow as tf
+    from src.models.UserGru import UserGruModel
+    from src.trainers.UserGru_evaluator import UserGruEval
+
+    args.load_model_config()
+    checkpoint = CHECKPOINT_DIR + args.name + '.ckpt'
+    results = []
+    for mode in [None] + QUANTIZATION_MODES:
+        if mode is not None:
+            export_weights(checkpoint, quantize=mode)
+        tf.reset_default_graph()
+        sess = get_tensorflow_session()
+        model = UserGruModel(args)
+        test_loader = get_data_loader(args.test_path, args)
+        evaluator = UserGruEval(sess, model, args, test_loader)
+        evaluator.load(checkpoint)
+        nbytes = quantized_nbytes = 0
+        if mode is not None:
+            nbytes, quantized_nbytes = evaluator.quantize_weights(
+                mode, QUANTIZED_WEIGHTS)
+        acc, mrr = evaluator.run_evaluation()
+        results.append((mode or 'float32', nbytes, quantized_nbytes,
+                        acc, mrr))
+        sess.close()
+
+    float_acc, float_mrr = results[0][3], results[0][4]
+    print('++ Quantization of {} ++'.format(', '.join(QUANTIZED_WEIGHTS)))
+    for mode, nbytes, quantized_nbytes, acc, mrr in results:
+        size = quantized_nbytes if quantized_nbytes else results[1][1]
+        print('{:8s} {:8.1f}MB'.format(mode, size / 1024. / 1024.))
+        for i, k in enumerate(args.cutoffs):
+            print('  Recall@{}: {:.5f} ({:+.5f})  -  MRR@{}: {:.5f} '
+                  '({:+.5f})'.format(k, acc[i], acc[i] - float_acc[i],
+                                     k, mrr[i], mrr[i] - float_mrr[i]))
+
+
+def run_index(args):
+    """
+    Build the item index of a trained model and report its recall against
+    exact search on final states of test events.
+    """
+    import tensorflow as tf
+    from src.models.UserGru import UserGruModel
+
+    args.load_model_config()
+    checkpoint = CHECKPOINT_DIR + args.name + '.ckpt'
+    export_dir = get_export_dir(checkpoint)
+    if is_stale(checkpoint, export_dir):
+        export_weights(checkpoint, export_dir)
+    weights = load_weights(export_dir, ['w_fc', 'b_fc'])
+    if 'w_fc' not in weights:
+        print('The model has no output layer to index')
+        return
+    index = ItemIndex.build(weights['w_fc'], weights['b_fc'],
+                            args.num_clusters)
+    index.save(get_index_path(checkpoint))
+    print('++ Item index: {} items - {} clusters ++'.format(
+        len(index.item_ids), index.num_clusters))
+
+    args.streaming = 0
+    args.input_mode = 'placeholder'
+    sess = get_tensorflow_session()
+    model = UserGruModel(args)
+    tf.train.Saver().restore(sess, checkpoint)
+    loader = DataLoader(args.test_path, args)
+    loader.next_epoch()
+    queries, num_queries = [], 0
+    while loader.has_next() and num_queries < args.num_queries:
+        columns = split_batch(loader.next_batch())
+        final_state = sess.run(model.get_final_state(),
+                               feed_dict=model.get_feed_dict(columns))
+        final_state = final_state[columns['next_items'].reshape(-1) != 0]
+        queries.append(final_state)
+        num_queries += len(final_state)
+    queries = np.concatenate(queries)[:args.num_queries]
+
+    for k in args.cutoffs:
+        for nprobe in [1, 2, 4, 8, 16, 32, 64]:
+            recall, exact_time, index_time = index.measure_recall(
+                queries, k, nprobe)
+            print('Recall@{} nprobe {}: {:.4f}  -  Exact: {:.3f}ms  -  '
+                  'Index: {:.3f}ms'.format(
+                      k, nprobe, recall, 1000. * exact_time / len(queries),
+                      1000. * index_time / len(queries)))
+            if nprobe >= index.num_clusters:
+                break
+
+
+def run_parity(args, batch_size=32, num_items=1000, num_users=100):
+    """
+    Compare the NumPy engine with the TF graph on random sessions, for
+    every cell, combination and fusion type, from the same randomly
+    initialized variables: output distributions, log-probabilities and
+    top-k items of the batch model, and of the step model over the same
+    sessions fed event by event.
+    :return: True if every configuration is within tolerance
+    """
+    import tensorflow as tf
+    from src.models.UserGru import UserGruModel
+    from src.models.numpy_engine import NumpyUserGru
+
+    k = max(args.cutoffs)
+    rng = np.random.RandomState(0)
+    all_close = True
+    for cell in ['gru', 'lstm']:
+        for fusion_type in ['pre', 'post']:
+            for combination in ['linear', 'linear-context', 'adaptive',
+                                'adaptive-context', 'weighted', 'voting']:
+                if fusion_type == 'pre' and combination == 'voting':
+                    continue
+                config = copy.copy(args)
+                config.cell, config.fusion_type = cell, fusion_type
+                config.combination = combination
+                config.num_items, config.num_users = num_items, num_users
+                config.max_length = config.max_length or 10
+                config.input_mode, config.streaming = 'placeholder', 0
+                config.inference_only, config.shared_weights = 1, None
+
+                tf.reset_default_graph()
+                sess = get_tensorflow_session()
+                model = UserGruModel(config)
+                model.build_step_model()
+                sess.run(tf.global_variables_initializer())
+                weights = {v.name[:-2]: value for v, value in zip(
+                    tf.global_variables(), sess.run(tf.global_variables()))
+                    if is_model_variable(v.name[:-2])}
+                engine = NumpyUserGru(config, weights)
+
+                # Random sessions padded after a random length
+                shape = [batch_size, config.max_length]
+                length = rng.randint(1, config.max_length + 1, batch_size)
+                mask = np.arange(config.max_length) < length[:, None]
+                columns = {
+                    c: rng.randint(1, len(weights['embeddings/E' + e]),
+                                   shape) * mask
+                    for c, e in zip(['user', 'item', 'day_of_week',
+                                     'month_period', 'next_items'],
+                                    'uidmi')}
+                tf_prob = sess.run(model.get_output(),
+                                   feed_dict=model.get_feed_dict(columns))
+                np_prob, _ = engine.run(columns)
+                rows = mask.reshape(-1)
+                results = [_compare(tf_prob[rows], np_prob[rows], k)]
+
+                tf_state = model.get_step_zero_state(batch_size)
+                np_state = engine.zero_state(batch_size)
+                tf_steps, np_steps = [], []
+                for t in range(config.max_length):
+                    events = np.stack([columns[c][:, t] for c in [
+                        'user', 'item', 'day_of_week', 'month_period']], 1)
+                    output, next_state = model.get_step_output()
+                    prob, tf_state = sess.run(
+                        [output, next_state],
+                        feed_dict=model.get_step_feed_dict(events, tf_state))
+                    tf_steps.append(prob[mask[:, t]])
+                    prob, np_state, _ = engine.step(events, np_state)
+                    np_steps.append(prob[mask[:, t]])
+                results.append(_compare(np.concatenate(tf_steps),
+                                        np.concatenate(np_steps), k))
+                sess.close()
+
+                close = all(r[1] < 1e-4 for r in results)
+                all_close = all_close and close
+                for name, (max_diff, max_log_diff, overlap) in zip(
+                        ['batch', 'step'], results):
+                    print('{:4s} {:4s} {:16s} {:5s}  -  Max |dp|: {:.2e}  -  '
+                          'Max |dlog p|: {:.2e}  -  Top-{} overlap: {:.4f}'
+                          '  {}'.format(cell, fusion_type, combination, name,
+                                        max_diff, max_log_diff, k, overlap,
+                                        'OK' if close else 'MISMATCH'))
+    return all_close
+
+
+def _compare(tf_prob, np_prob, k):
+    """
+    :return: max absolute difference of the distributions and of their logs
+             (the logits up to a constant), and the top-k overlap
+    """
+    top_tf = np.argsort(-tf_prob, axis=1)[:, :k]
+    top_np = np.argsort(-np_prob, axis=1)[:, :k]
+    overlap = np.mean([len(np.intersect1d(a, b)) / float(k)
+                       for a, b in zip(top_tf, top_np)])
+    return float(np.max(np.abs(tf_prob - np_prob))), \
+        float(np.max(np.abs(np.log(tf_prob) - np.log(np_prob)))), overlap
+
+
 if __name__ == '__main__':
     try:
         args = Args()
@@ -102,5 +429,13 @@ if __name__ == '__main__':
         exit(0)
     if args.mode == 'train':
         run_training(args)
+    elif args.mode == 'index':
+        run_index(args)
+    elif args.mode == 'export':
+        run_export(args)
+    elif args.mode == 'quantize':
+        run_quantization(args)
+    elif args.mode == 'parity':
+        exit(0 if run_parity(args) else 1)
     else:
         run_evaluation(args)
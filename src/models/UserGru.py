@@ -2,10 +2,13 @@ import sys
 sys.path.append('../..')  # noqa
 
 
+import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.rnn import *
+from tensorflow.python.util import nest
 
 from src.base.base_model import BaseModel
+from src.data_loader.dataset import SessionDataset
 
 
 class UserGruModel(BaseModel):
@@ -28,20 +31,38 @@ class UserGruModel(BaseModel):
         self._combination = config.combination
         self._fusion_type = config.fusion_type
 
-        # Placeholder
-        self.user = tf.placeholder(tf.int32, shape=[None, self._max_length])
-        self.item = tf.placeholder(tf.int32, shape=[None, self._max_length])
-        self.day_of_week = tf.placeholder(
-            tf.int32, shape=[None, self._max_length])
-        self.month_period = tf.placeholder(
-            tf.int32, shape=[None, self._max_length])
-        self.next_items = tf.placeholder(
-            tf.int32, shape=[None, self.config.max_length])
-        self.labels = tf.one_hot(depth=self.config.num_items + 1,
-                                 indices=self.next_items, dtype=tf.int32)
-        self.keep_pr = tf.placeholder(tf.float32)
+        # Training objective
+        self._loss_type = config.loss
+        self._num_sampled = config.num_sampled
+
+        # Read-only arrays used in place of variables (serving only)
+        self._shared_weights = config.shared_weights or {}
+
+        # Input
+        self.dataset = None
+        if config.input_mode == 'dataset':
+            self.dataset = SessionDataset(config)
+            self.user = self.dataset.inputs['user']
+            self.item = self.dataset.inputs['item']
+            self.day_of_week = self.dataset.inputs['day_of_week']
+            self.month_period = self.dataset.inputs['month_period']
+            self.next_items = self.dataset.inputs['next_items']
+        else:
+            self.user = tf.placeholder(
+                tf.int32, shape=[None, self._max_length])
+            self.item = tf.placeholder(
+                tf.int32, shape=[None, self._max_length])
+            self.day_of_week = tf.placeholder(
+                tf.int32, shape=[None, self._max_length])
+            self.month_period = tf.placeholder(
+                tf.int32, shape=[None, self._max_length])
+            self.next_items = tf.placeholder(
+                tf.int32, shape=[None, self.config.max_length])
+        self.keep_pr = tf.placeholder_with_default(1., shape=[])
 
         self.length = tf.reduce_sum(tf.sign(self.next_items), axis=1)
+        self.mask = tf.reshape(tf.sequence_mask(
+            self.length, self._max_length, dtype=tf.float32), [-1])
         self.global_step = tf.Variable(0, name="global_step",
                                        trainable=False)
 
@@ -59,8 +80,22 @@ class UserGruModel(BaseModel):
         self.loss = None
         self.optimizer = None
         self.train_op = None
+        self._final_state = None
         self._logits = None
         self._output_prob = None
+        self._ranks = None
+        self._eval_ops = None
+
+        # Step-wise inference
+        self.step_user = None
+        self.step_item = None
+        self.step_day_of_week = None
+        self.step_month_period = None
+        self.step_state = None
+        self.step_next_state = None
+        self._step_output = None
+        self._step_final_state = None
+        self._step_alpha = None
 
         self.build_model()
         self.print_info()
@@ -78,6 +113,8 @@ class UserGruModel(BaseModel):
         print('- Hidden unit: ', self._hidden_units)
         print('- Num layers: ', self._num_layers)
         print('- RNN cell: ', self._cell)
+        print('- Input mode: ', self.config.input_mode)
+        print('- Loss: ', self._loss_type)
 
     def build_model(self):
         with tf.variable_scope('embeddings'):
@@ -86,12 +123,16 @@ class UserGruModel(BaseModel):
                                [self._entity_embedding] * 2 +
                                [self._context_embedding] * 2,
                                ['i', 'u', 'd', 'm']):
-                self._E[k] = tf.get_variable(shape=[x, y],
-                                             name='E' + k, dtype=tf.float32)
+                name = 'embeddings/E' + k
+                if name in self._shared_weights:
+                    self._E[k] = self._shared_weights[name]
+                else:
+                    self._E[k] = tf.get_variable(
+                        shape=[x, y], name='E' + k, dtype=tf.float32)
         for v, k in zip([self.item, self.user,
                          self.day_of_week, self.month_period],
                         ['i', 'u', 'd', 'm']):
-            self._embs[k] = tf.nn.embedding_lookup(self._E[k], v)
+            self._embs[k] = self._embedding_lookup(k, v)
 
         self._embs['u'] = tf.nn.dropout(self._embs['u'], self.keep_pr)
         self._embs['i'] = tf.nn.dropout(self._embs['i'], self.keep_pr)
@@ -111,18 +152,29 @@ class UserGruModel(BaseModel):
                         for _ in range(self._num_layers)])
 
         if self._fusion_type == 'pre':
-            self._logits = self._pre_fusion()
+            self._logits, self._final_state = self._pre_fusion(
+                self._embs, self._dynamic_rnn)
         elif self._fusion_type == 'post':
-            self._logits = self._post_fusion()
+            self._logits, self._final_state = self._post_fusion(
+                self._embs, self._dynamic_rnn)
         else:
             print('Unkown fusion type')
             exit()
 
         self._output_prob = tf.nn.softmax(self._logits)
-
-        self.loss = tf.nn.softmax_cross_entropy_with_logits(
-            labels=self.labels, logits=self._logits)
-        self.loss = tf.reduce_mean(self.loss)
+        self._build_eval_ops()
+        if self._shared_weights or self.config.inference_only:
+            # Serving graph, no loss, optimizer or slot variables
+            return
+
+        if self._loss_type == 'softmax' or self._final_state is None:
+            self.loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=tf.reshape(self.next_items, [-1]), logits=self._logits)
+        else:
+            self.loss = self._sampled_loss()
+        # Average over real events only, padded timesteps are masked out
+        self.loss = tf.reduce_sum(self.loss * self.mask) / \
+            tf.maximum(tf.reduce_sum(self.mask), 1.)
 
         # Optimizer
         self.optimizer = tf.train.AdamOptimizer(
@@ -130,100 +182,240 @@ class UserGruModel(BaseModel):
         self.train_op = self.optimizer.minimize(
             self.loss, global_step=self.global_step)
 
-    def _feed_forward(self, inputs, output_size, key, activation=None):
+    def build_step_model(self):
+        """
+        Single-timestep inference graph sharing the model variables.
+        It feeds one event per session through the RNN cell from a given
+        recurrent state and returns the next-item distribution together with
+        the updated state, so serving does not rerun the whole sequence.
+        """
+        with tf.name_scope('step'), tf.variable_scope(
+                tf.get_variable_scope(), reuse=True):
+            self.step_user = tf.placeholder(tf.int32, shape=[None])
+            self.step_item = tf.placeholder(tf.int32, shape=[None])
+            self.step_day_of_week = tf.placeholder(tf.int32, shape=[None])
+            self.step_month_period = tf.placeholder(tf.int32, shape=[None])
+            self.step_state = nest.map_structure(
+                lambda size: tf.placeholder(tf.float32, shape=[None, size]),
+                self._rnn_cell.state_size)
+
+            embs = {}
+            for v, k in zip([self.step_item, self.step_user,
+                             self.step_day_of_week, self.step_month_period],
+                            ['i', 'u', 'd', 'm']):
+                embs[k] = self._embedding_lookup(k, tf.expand_dims(v, 1))
+
+            def rnn(inputs):
+                output, self.step_next_state = self._rnn_cell(
+                    inputs[:, 0], self.step_state)
+                return tf.expand_dims(output, 1)
+
+            alpha = self._alpha
+            if self._fusion_type == 'pre':
+                logits, self._step_final_state = self._pre_fusion(embs, rnn)
+            else:
+                logits, self._step_final_state = self._post_fusion(embs, rnn)
+            self._step_alpha, self._alpha = self._alpha, alpha
+            self._step_output = tf.nn.softmax(logits)
+
+    def get_step_zero_state(self, batch_size):
+        return nest.map_structure(
+            lambda size: np.zeros([batch_size, size], dtype=np.float32),
+            self._rnn_cell.state_size)
+
+    def get_step_feed_dict(self, events, state):
+        """
+        :param events: [batch, 4] array of (user, item, day, half month)
+        :param state: recurrent state from get_step_zero_state or a
+                      previous step
+        """
+        feed_dict = {
+            self.step_user: events[:, 0],
+            self.step_item: events[:, 1],
+            self.step_day_of_week: events[:, 2],
+            self.step_month_period: events[:, 3]
+        }
+        for placeholder, value in zip(nest.flatten(self.step_state),
+                                      nest.flatten(state)):
+            feed_dict[placeholder] = value
+        return feed_dict
+
+    def get_step_output(self):
+        return self._step_output, self.step_next_state
+
+    def get_step_final_state(self):
+        return self._step_final_state
+
+    def _build_eval_ops(self):
+        # Ranks of the target items and per-batch Recall@k / MRR@k counters,
+        # so evaluation never fetches the full output distribution
+        with tf.name_scope('evaluation'):
+            targets = tf.reshape(self.next_items, [-1])
+            target_idx = tf.stack(
+                [tf.range(tf.shape(targets)[0]), targets], axis=1)
+            target_logits = tf.expand_dims(
+                tf.gather_nd(self._logits, target_idx), 1)
+            self._ranks = tf.reduce_sum(tf.cast(
+                self._logits > target_logits, tf.int32), axis=1) + 1
+
+            is_target = tf.cast(tf.not_equal(targets, 0), tf.float32)
+            cutoffs = tf.constant(self.config.cutoffs, dtype=tf.int32)
+            hits = tf.cast(tf.expand_dims(self._ranks, 1) <= cutoffs,
+                           tf.float32) * tf.expand_dims(is_target, 1)
+            rr = hits / tf.cast(tf.expand_dims(self._ranks, 1), tf.float32)
+            self._eval_ops = [tf.reduce_sum(hits, axis=0),
+                              tf.reduce_sum(rr, axis=0),
+                              tf.cast(tf.reduce_sum(is_target), tf.int32)]
+
+    def _candidate_sampler(self, labels):
+        # Sample negatives by item popularity when training counts are known
+        if self.config.item_counts is None:
+            return tf.nn.uniform_candidate_sampler(
+                labels, num_true=1, num_sampled=self._num_sampled,
+                unique=True, range_max=self._num_items + 1)
+        return tf.nn.fixed_unigram_candidate_sampler(
+            labels, num_true=1, num_sampled=self._num_sampled,
+            unique=True, range_max=self._num_items + 1,
+            distortion=self.config.sampling_distortion,
+            unigrams=[float(c) for c in self.config.item_counts])
+
+    def _sampled_loss(self):
+        with tf.name_scope('sampled_loss'):
+            labels = tf.reshape(tf.cast(self.next_items, tf.int64), [-1, 1])
+            # w_fc is stored [num_items + 1, D], so the samplers gather its
+            # rows directly
+            weights = self._w['fc']
+            sampled_values = self._candidate_sampler(labels)
+            if self._loss_type == 'nce':
+                return tf.nn.nce_loss(
+                    weights=weights, biases=self._b['fc'], labels=labels,
+                    inputs=self._final_state, num_sampled=self._num_sampled,
+                    num_classes=self._num_items + 1,
+                    sampled_values=sampled_values)
+            return tf.nn.sampled_softmax_loss(
+                weights=weights, biases=self._b['fc'], labels=labels,
+                inputs=self._final_state, num_sampled=self._num_sampled,
+                num_classes=self._num_items + 1,
+                sampled_values=sampled_values)
+
+    def _embedding_lookup(self, key, ids):
+        E = self._E[key]
+        if isinstance(E, tf.Variable):
+            return tf.nn.embedding_lookup(E, ids)
+        # Gather rows of a shared array, only the looked up rows are copied
+        embs = tf.py_func(lambda i: E[i], [ids], tf.float32, stateful=False)
+        embs.set_shape(ids.shape.concatenate(E.shape[1]))
+        return embs
+
+    def _feed_forward(self, inputs, output_size, key, activation=None,
+                      transposed=False):
+        """
+        :param transposed: store the weights as [output_size, input_size],
+                           the layout expected by the sampled losses
+        """
         with tf.name_scope('feedforward_' + key):
-            if key in self._w.keys():
+            if key in self._w.keys() and not tf.get_variable_scope().reuse:
                 print('Variable with key w_%s already exists' % key)
                 exit(0)
-            self._w[key] = tf.get_variable(
-                shape=[int(inputs.shape[-1]), output_size],
-                name='w_' + key, dtype=tf.float32)
-            self._b[key] = tf.get_variable(
-                shape=[output_size], name='b_' + key, dtype=tf.float32)
-            output = tf.nn.xw_plus_b(inputs, self._w[key], self._b[key])
+            if 'w_' + key in self._shared_weights:
+                w = self._w[key] = self._shared_weights['w_' + key]
+                b = self._b[key] = self._shared_weights['b_' + key]
+                if transposed:
+                    w = w.T
+                output = tf.py_func(lambda x: x @ w + b, [inputs],
+                                    tf.float32, stateful=False)
+                output.set_shape([inputs.shape[0], output_size])
+            else:
+                shape = [int(inputs.shape[-1]), output_size]
+                self._w[key] = tf.get_variable(
+                    shape=shape[::-1] if transposed else shape,
+                    name='w_' + key, dtype=tf.float32)
+                self._b[key] = tf.get_variable(
+                    shape=[output_size], name='b_' + key, dtype=tf.float32)
+                output = tf.nn.bias_add(
+                    tf.matmul(inputs, self._w[key], transpose_b=transposed),
+                    self._b[key])
             if activation is None:
                 return output
             return activation(output)
 
-    def _pre_fusion(self):
+    def _dynamic_rnn(self, inputs):
+        output_states, _ = tf.nn.dynamic_rnn(
+            self._rnn_cell, inputs, sequence_length=self.length,
+            dtype=tf.float32)
+        return output_states
+
+    def _pre_fusion(self, embs, rnn):
         if self._combination == 'linear':
-            inputs = tf.concat([self._embs['i'], self._embs['u']], 2)
+            inputs = tf.concat([embs['i'], embs['u']], 2)
         elif self._combination == 'linear-context':
-            inputs = tf.concat([self._embs['i'], self._embs['u'],
-                                self._embs['d'], self._embs['m']], 2)
+            inputs = tf.concat([embs['i'], embs['u'],
+                                embs['d'], embs['m']], 2)
         elif self._combination == 'adaptive':
-            inputs = self._adaptive_gate(self._embs['i'], self._embs['u'])
+            inputs = self._adaptive_gate(embs['i'], embs['u'])
         elif self._combination == 'adaptive-context':
             inputs = self._adaptive_gate_context(
-                self._embs['i'], self._embs['u'], self._embs['d'],
-                self._embs['m'])
+                embs['i'], embs['u'], embs['d'], embs['m'])
         elif self._combination == 'weighted':
-            inputs = self._weighted_gate(self._embs['i'], self._embs['u'])
+            inputs = self._weighted_gate(embs['i'], embs['u'])
         else:
             print('Unrecognize input type.Exit')
             exit(0)
 
-        output_states, _ = tf.nn.dynamic_rnn(
-            self._rnn_cell, inputs, sequence_length=self.length,
-            dtype=tf.float32)
+        output_states = rnn(inputs)
         output_states = tf.reshape(output_states, [-1, self._hidden_units])
 
-        self._logits = self._feed_forward(
-            output_states, self._num_items + 1, key='fc')
+        logits = self._feed_forward(
+            output_states, self._num_items + 1, key='fc', transposed=True)
 
-        return self._logits
+        return logits, output_states
 
-    def _post_fusion(self):
-        output_states, _ = tf.nn.dynamic_rnn(
-            self._rnn_cell, self._embs['i'], sequence_length=self.length,
-            dtype=tf.float32)
+    def _post_fusion(self, embs, rnn):
+        output_states = rnn(embs['i'])
         if self._combination == 'linear':
             final_state = tf.reshape(
-                tf.concat([output_states, self._embs['u']], -1),
+                tf.concat([output_states, embs['u']], -1),
                 [-1, self._hidden_units + self._entity_embedding])
         elif self._combination == 'linear-context':
             final_state = tf.reshape(
-                tf.concat([output_states, self._embs['u'],
-                           self._embs['d'], self._embs['m']], -1),
+                tf.concat([output_states, embs['u'],
+                           embs['d'], embs['m']], -1),
                 [-1, self._hidden_units + self._entity_embedding +
                  2 * self._context_embedding])
         elif self._combination == 'adaptive':
-            final_state = self._adaptive_gate(output_states, self._embs['u'])
+            final_state = self._adaptive_gate(output_states, embs['u'])
             final_state = tf.reshape(
                 final_state, [-1, self._hidden_units + self._entity_embedding])
         elif self._combination == 'adaptive-context':
             final_state = self._adaptive_gate_context(
-                output_states, self._embs['u'], self._embs['d'],
-                self._embs['m'])
+                output_states, embs['u'], embs['d'], embs['m'])
             final_state = tf.reshape(
                 final_state,
                 [-1, self._hidden_units + self._entity_embedding +
                  2 * self._context_embedding])
         elif self._combination == 'weighted':
-            final_state = self._weighted_gate(output_states, self._embs['u'])
+            final_state = self._weighted_gate(output_states, embs['u'])
             final_state = tf.reshape(
                 final_state,
                 [-1, self._hidden_units + self._entity_embedding])
         elif self._combination == 'voting':
             output_states = tf.reshape(output_states, [-1, self._hidden_units])
-            user_embs = tf.reshape(self._embs['u'],
-                                   [-1, self._entity_embedding])
+            user_embs = tf.reshape(embs['u'], [-1, self._entity_embedding])
             vote_user = self._feed_forward(
                 user_embs, self._num_items + 1, key='vote_u',
                 activation=tf.nn.softmax)
             vote_item = self._feed_forward(
                 output_states, self._num_items + 1, key='vote_i',
                 activation=tf.nn.softmax)
-            self._logits = vote_user + vote_item
-            return self._logits
+            return vote_user + vote_item, None
         else:
             print('Unrecognize input type.Exit')
             exit(0)
 
-        self._logits = self._feed_forward(
-            final_state, self._num_items + 1, key='fc')
+        logits = self._feed_forward(
+            final_state, self._num_items + 1, key='fc', transposed=True)
 
-        return self._logits
+        return logits, final_state
 
     def _adaptive_gate_context(self, item, user, day, month):
         with tf.name_scope('adaptive'):
@@ -243,33 +435,25 @@ class UserGruModel(BaseModel):
             alpha.append(tf.sigmoid(tf.reduce_sum(
                 tf.cast(x, tf.float32) * self._Va[k], axis=2) + self._ba[k]))
 
-        self._alpha = []
-        for t in range(self._max_length):
-            wt = []
-            for i in range(4):
-                wt.append(alpha[i][:, t])
-            sum_exp = tf.reduce_sum(tf.exp(wt), axis=0)
-            self._alpha.append([tf.exp(w_) / sum_exp for w_ in wt])
-
-        self._alpha = tf.transpose(tf.stack(self._alpha), [2, 0, 1])
+        # [batch, max_length, 4], one softmax over the inputs of every step
+        self._alpha = tf.nn.softmax(tf.stack(alpha, axis=2))
         final_input = []
         for i, x in enumerate([item, user, day, month]):
             final_input.append(tf.expand_dims(self._alpha[:, :, i], dim=2) * x)
         return tf.concat(final_input, -1)
 
     def _adaptive_gate(self, item, user):
+        max_length = int(item.shape[1])
         with tf.name_scope('adaptive_gate'):
             item = tf.reshape(item, shape=[-1, item.shape[-1]])
             item = self._feed_forward(item, self._hidden_units, key='a_item',
                                       activation=tf.nn.tanh)
-            item = tf.reshape(item, shape=[-1, self._max_length,
-                                           item.shape[-1]])
+            item = tf.reshape(item, shape=[-1, max_length, item.shape[-1]])
 
             user = tf.reshape(user, shape=[-1, user.shape[-1]])
             user = self._feed_forward(user, self._hidden_units, key='a_user',
                                       activation=tf.nn.tanh)
-            user = tf.reshape(user, shape=[-1, self._max_length,
-                                           user.shape[-1]])
+            user = tf.reshape(user, shape=[-1, max_length, user.shape[-1]])
             for x, k in zip([self._hidden_units, self._hidden_units],
                             ['i', 'u']):
                 self._Va[k] = tf.get_variable(shape=[x],
@@ -284,14 +468,8 @@ class UserGruModel(BaseModel):
             alpha.append(tf.reduce_sum(
                 tf.cast(x, tf.float32) * self._Va[k], axis=2) + self._ba[k])
 
-        self._alpha = []
-        for t in range(self._max_length):
-            wt = []
-            for i in range(2):
-                wt.append(alpha[i][:, t])
-            sum_exp = tf.reduce_sum(tf.exp(wt), axis=0)
-            self._alpha.append([tf.exp(w_) / sum_exp for w_ in wt])
-        self._alpha = tf.transpose(tf.stack(self._alpha), [2, 0, 1])
+        # [batch, max_length, 2], one softmax over the inputs of every step
+        self._alpha = tf.nn.softmax(tf.stack(alpha, axis=2))
         final_input = []
         for i, x in enumerate([item, user]):
             final_input.append(tf.expand_dims(self._alpha[:, :, i], dim=2) * x)
@@ -308,11 +486,35 @@ class UserGruModel(BaseModel):
         user = user * attention_w[1]
         return tf.concat([item, user], -1)
 
+    def get_feed_dict(self, columns, keep_pr=1):
+        if self.dataset is not None:
+            return {self.keep_pr: keep_pr}
+        return {
+            self.user: columns['user'],
+            self.item: columns['item'],
+            self.day_of_week: columns['day_of_week'],
+            self.month_period: columns['month_period'],
+            self.next_items: columns['next_items'],
+            self.keep_pr: keep_pr
+        }
+
     def get_training_vars(self):
         return self.train_op, self.loss, self.global_step
 
     def get_output(self):
         return self._output_prob
 
+    def get_final_state(self):
+        """
+        Input of the output layer, None for the voting combination.
+        """
+        return self._final_state
+
+    def get_ranks(self):
+        return self._ranks
+
+    def get_eval_ops(self):
+        return self._eval_ops
+
     def get_attention_weight(self):
         return self._alpha
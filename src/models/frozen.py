@@ -0,0 +1,142 @@
+import json
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.util import nest
+from tensorflow.tools.graph_transforms import TransformGraph
+
+
+_INPUTS = ['user', 'item', 'day_of_week', 'month_period', 'next_items',
+           'keep_pr']
+_STEP_INPUTS = ['step_user', 'step_item', 'step_day_of_week',
+                'step_month_period']
+
+
+def get_frozen_path(checkpoint):
+    return checkpoint + '.frozen.pb'
+
+
+def export_frozen_graph(sess, model, path):
+    """
+    Write the inference part of a restored UserGruModel as a GraphDef with
+    the variables turned into constants, pruned to the output tensors and
+    with constant subgraphs folded. The tensor names are kept in
+    <path>.json.
+    """
+    inputs = {k: getattr(model, k).name for k in _INPUTS}
+    outputs = {'output': model.get_output().name}
+    if model.get_final_state() is not None:
+        outputs['final_state'] = model.get_final_state().name
+    step = None
+    if model.step_user is not None:
+        output, next_state = model.get_step_output()
+        step = {k: getattr(model, k).name for k in _STEP_INPUTS}
+        step['state'] = [t.name for t in nest.flatten(model.step_state)]
+        step['state_size'] = [int(t.shape[-1])
+                              for t in nest.flatten(model.step_state)]
+        step['next_state'] = [t.name for t in nest.flatten(next_state)]
+        step['output'] = output.name
+        if model.get_step_final_state() is not None:
+            step['final_state'] = model.get_step_final_state().name
+
+    fetches = list(outputs.values())
+    if step is not None:
+        fetches += step['next_state'] + [step['output']]
+        if 'final_state' in step:
+            fetches.append(step['final_state'])
+    output_nodes = sorted(set(t.split(':')[0] for t in fetches))
+    input_nodes = [t.split(':')[0] for t in inputs.values()]
+    if step is not None:
+        input_nodes += [step[k].split(':')[0] for k in _STEP_INPUTS] + \
+            [t.split(':')[0] for t in step['state']]
+
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        sess, sess.graph.as_graph_def(), output_nodes)
+    graph_def = tf.graph_util.remove_training_nodes(
+        graph_def, protected_nodes=output_nodes + input_nodes)
+    graph_def = TransformGraph(graph_def, input_nodes, output_nodes,
+                               ['fold_constants(ignore_errors=true)'])
+
+    with open(path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    with open(path + '.json', 'w') as f:
+        json.dump({'max_length': model.config.max_length, 'inputs': inputs,
+                   'outputs': outputs, 'step': step}, f, indent=2)
+    print('++ Export frozen graph: {} nodes - {:.1f}MB to {} ++'.format(
+        len(graph_def.node), graph_def.ByteSize() / 1024. / 1024., path))
+
+
+class FrozenModel(object):
+    """
+    Inference model imported from export_frozen_graph, with the interface
+    UserGruPredict uses on UserGruModel. There are no variables to restore,
+    the step state is a flat tuple of arrays.
+    """
+    frozen = True
+
+    def __init__(self, path):
+        with open(path + '.json') as f:
+            self._signature = json.load(f)
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        tf.import_graph_def(graph_def, name='')
+        graph = tf.get_default_graph()
+
+        def get(name):
+            return graph.get_tensor_by_name(name)
+
+        for k, name in self._signature['inputs'].items():
+            setattr(self, k, get(name))
+        outputs = self._signature['outputs']
+        self._output_prob = get(outputs['output'])
+        self._final_state = get(outputs['final_state']) \
+            if 'final_state' in outputs else None
+
+        step = self._signature['step']
+        self.step_user = None
+        self._step_final_state = None
+        if step is not None:
+            for k in _STEP_INPUTS:
+                setattr(self, k, get(step[k]))
+            self.step_state = tuple(get(t) for t in step['state'])
+            self.step_next_state = tuple(get(t) for t in step['next_state'])
+            self._step_output = get(step['output'])
+            if 'final_state' in step:
+                self._step_final_state = get(step['final_state'])
+        print('++ Load frozen graph from {} ++'.format(path))
+
+    def build_step_model(self):
+        if self.step_user is None:
+            raise ValueError('The frozen graph was exported without the '
+                             'step model, export with --step_inference 1')
+
+    def get_step_zero_state(self, batch_size):
+        return tuple(np.zeros([batch_size, size], dtype=np.float32)
+                     for size in self._signature['step']['state_size'])
+
+    def get_step_feed_dict(self, events, state):
+        feed_dict = {
+            self.step_user: events[:, 0],
+            self.step_item: events[:, 1],
+            self.step_day_of_week: events[:, 2],
+            self.step_month_period: events[:, 3]
+        }
+        for placeholder, value in zip(self.step_state, state):
+            feed_dict[placeholder] = value
+        return feed_dict
+
+    def get_step_output(self):
+        return self._step_output, self.step_next_state
+
+    def get_step_final_state(self):
+        return self._step_final_state
+
+    def get_output(self):
+        return self._output_prob
+
+    def get_final_state(self):
+        return self._final_state
+
+    def get_attention_weight(self):
+        return None
@@ -0,0 +1,213 @@
+import numpy as np
+
+from src.utils.weights import is_model_variable, load_weights
+
+
+def _sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def _softmax(x, axis=-1):
+    e = np.exp(x - np.max(x, axis=axis, keepdims=True))
+    return e / np.sum(e, axis=axis, keepdims=True)
+
+
+class NumpyUserGru(object):
+    """
+    UserGruModel inference in NumPy, from the variables of a checkpoint or
+    of an export (float32 or quantized). It follows the TF graph op by op:
+    tf.contrib GRUCell / LSTMCell layers, dynamic_rnn with sequence_length
+    (zero outputs and frozen state past the length), the input gates and
+    the pre, post and voting fusions.
+    The recurrent state is a tuple with one entry per layer, an array for
+    GRU and a (c, h) tuple for LSTM.
+    """
+    numpy_engine = True
+
+    def __init__(self, config, weights):
+        self.config = config
+        self._weights = weights
+        self._max_length = config.max_length
+        self._hidden_units = config.hidden_units
+        self._num_layers = config.num_layers
+        self._combination = config.combination
+        self._fusion_type = config.fusion_type
+        self._cell = config.cell
+        if self._cell not in ('gru', 'lstm'):
+            raise ValueError('Unsupported cell: {}'.format(self._cell))
+        self._E = {k: weights['embeddings/E' + k] for k in 'iudm'}
+
+    @classmethod
+    def from_checkpoint(cls, config, checkpoint):
+        import tensorflow as tf
+
+        reader = tf.train.NewCheckpointReader(checkpoint)
+        return cls(config, {
+            name: reader.get_tensor(name)
+            for name in reader.get_variable_to_shape_map()
+            if is_model_variable(name)})
+
+    @classmethod
+    def from_export(cls, config, export_dir):
+        return cls(config, load_weights(export_dir))
+
+    def _cell_weight(self, layer, name):
+        cell = 'gru_cell' if self._cell == 'gru' else 'lstm_cell'
+        return self._weights['rnn/multi_rnn_cell/cell_{}/{}/{}'.format(
+            layer, cell, name)]
+
+    def _dense(self, x, key, transposed=False):
+        w = self._weights['w_' + key]
+        return x @ (w.T if transposed else w) + self._weights['b_' + key]
+
+    def zero_state(self, batch_size):
+        zeros = np.zeros([batch_size, self._hidden_units], dtype=np.float32)
+        if self._cell == 'gru':
+            return tuple(zeros for _ in range(self._num_layers))
+        return tuple((zeros, zeros) for _ in range(self._num_layers))
+
+    get_step_zero_state = zero_state
+
+    def _gru_cell(self, layer, x, h):
+        gates = _sigmoid(
+            np.concatenate([x, h], 1) @ self._cell_weight(
+                layer, 'gates/kernel') +
+            self._cell_weight(layer, 'gates/bias'))
+        r, u = np.split(gates, 2, axis=1)
+        c = np.tanh(
+            np.concatenate([x, r * h], 1) @ self._cell_weight(
+                layer, 'candidate/kernel') +
+            self._cell_weight(layer, 'candidate/bias'))
+        h = u * h + (1 - u) * c
+        return h, h
+
+    def _lstm_cell(self, layer, x, state):
+        c, h = state
+        lstm_matrix = np.concatenate([x, h], 1) @ self._cell_weight(
+            layer, 'kernel') + self._cell_weight(layer, 'bias')
+        i, j, f, o = np.split(lstm_matrix, 4, axis=1)
+        # forget_bias of LSTMCell is 1
+        c = _sigmoid(f + 1.) * c + _sigmoid(i) * np.tanh(j)
+        h = _sigmoid(o) * np.tanh(c)
+        return h, (c, h)
+
+    def _multi_cell(self, x, state):
+        cell = self._gru_cell if self._cell == 'gru' else self._lstm_cell
+        next_state = []
+        for layer in range(self._num_layers):
+            x, layer_state = cell(layer, x, state[layer])
+            next_state.append(layer_state)
+        return x, tuple(next_state)
+
+    def _dynamic_rnn(self, inputs, length):
+        batch_size, max_length = inputs.shape[:2]
+        state = self.zero_state(batch_size)
+        outputs = np.zeros([batch_size, max_length, self._hidden_units],
+                           dtype=np.float32)
+        for t in range(max_length):
+            alive = (t < length)[:, None]
+            if not alive.any():
+                break
+            output, next_state = self._multi_cell(inputs[:, t], state)
+            outputs[:, t] = np.where(alive, output, 0.)
+            state = self._select(alive, next_state, state)
+        return outputs
+
+    @classmethod
+    def _select(cls, alive, new, old):
+        if isinstance(new, tuple):
+            return tuple(cls._select(alive, n, o) for n, o in zip(new, old))
+        return np.where(alive, new, old)
+
+    def _adaptive_gate(self, item, user):
+        item = np.tanh(self._dense(item, 'a_item'))
+        user = np.tanh(self._dense(user, 'a_user'))
+        alpha = _softmax(np.stack(
+            [np.sum(x * self._weights['Va_' + k], -1) +
+             self._weights['ba_' + k] for x, k in zip([item, user], 'iu')],
+            -1))
+        return np.concatenate([alpha[..., 0:1] * item,
+                               alpha[..., 1:2] * user], -1)
+
+    def _adaptive_gate_context(self, item, user, day, month):
+        alpha = _softmax(np.stack(
+            [_sigmoid(np.sum(x * self._weights['Va_' + k], -1) +
+                      self._weights['ba_' + k])
+             for x, k in zip([item, user, day, month], 'iudm')], -1))
+        return np.concatenate([alpha[..., i:i + 1] * x for i, x in
+                               enumerate([item, user, day, month])], -1)
+
+    def _weighted_gate(self, item, user):
+        # Same softmax axis as the graph, over the last axis of [2, 1]
+        attention_w = _softmax(np.stack(
+            [self._weights['Va_i'], self._weights['Va_u']]), -1)
+        return np.concatenate([item * attention_w[0],
+                               user * attention_w[1]], -1)
+
+    def _gate(self, x, embs):
+        if self._combination == 'linear':
+            return np.concatenate([x, embs['u']], -1)
+        if self._combination == 'linear-context':
+            return np.concatenate([x, embs['u'], embs['d'], embs['m']], -1)
+        if self._combination == 'adaptive':
+            return self._adaptive_gate(x, embs['u'])
+        if self._combination == 'adaptive-context':
+            return self._adaptive_gate_context(
+                x, embs['u'], embs['d'], embs['m'])
+        if self._combination == 'weighted':
+            return self._weighted_gate(x, embs['u'])
+        raise ValueError('Unknown combination: {}'.format(self._combination))
+
+    def _fusion(self, embs, rnn, output=True):
+        """
+        :return: output distribution (None if output is False) and final
+                 state, both flattened over the leading axes
+        """
+        if self._fusion_type == 'pre':
+            final_state = rnn(self._gate(embs['i'], embs))
+        elif self._combination == 'voting':
+            states = rnn(embs['i']).reshape([-1, self._hidden_units])
+            users = embs['u'].reshape([-1, embs['u'].shape[-1]])
+            logits = _softmax(self._dense(users, 'vote_u')) + \
+                _softmax(self._dense(states, 'vote_i'))
+            return _softmax(logits), None
+        else:
+            final_state = self._gate(rnn(embs['i']), embs)
+        final_state = final_state.reshape([-1, final_state.shape[-1]])
+        if not output:
+            return None, final_state
+        return _softmax(self._dense(final_state, 'fc', True)), final_state
+
+    def run(self, columns, output=True):
+        """
+        Batch inference over padded sessions.
+        :param columns: dict of [batch, max_length] arrays 'user', 'item',
+                        'day_of_week', 'month_period' and 'next_items' (only
+                        used for the session lengths)
+        :return: [batch * max_length, num_items + 1] distribution (None if
+                 output is False) and final states
+        """
+        length = np.sum(np.sign(columns['next_items']), axis=1)
+        embs = {k: self._E[k][columns[c]] for k, c in zip(
+            'iudm', ['item', 'user', 'day_of_week', 'month_period'])}
+        return self._fusion(
+            embs, lambda x: self._dynamic_rnn(x, length), output)
+
+    def step(self, events, state, output=True):
+        """
+        Advance a batch of sessions by one event each.
+        :param events: [batch, 4] array of (user, item, day, half month)
+        :return: distribution (None if output is False), next state and
+                 final states
+        """
+        embs = {k: self._E[k][events[:, c]]
+                for k, c in zip('iudm', [1, 0, 2, 3])}
+        next_state = []
+
+        def rnn(x):
+            out, s = self._multi_cell(x, state)
+            next_state.append(s)
+            return out
+
+        prob, final_state = self._fusion(embs, rnn, output)
+        return prob, next_state[0], final_state
@@ -2,10 +2,14 @@ import sys
 sys.path.append('../..')  # noqa
 
 import numpy as np
+import tensorflow as tf
 
 from time import time
 
 from src.base.base_eval import BaseEval
+from src.data_loader.prefetcher import BatchPrefetcher
+from src.utils.metrics import calculate_ranks, evaluate
+from src.utils.quantization import dequantize, quantize
 from src.utils.qpath import *
 
 
@@ -14,31 +18,35 @@ class UserGruEval(BaseEval):
                  data_loader, logger=None, init_graph=False):
         super(UserGruEval, self).__init__(
             sess, model, config, data_loader, logger, init_graph)
+        self.batches = BatchPrefetcher(data_loader, config.prefetch_depth)
+        self.compute_time = 0.
 
     def load(self, path):
         self.saver.restore(self.sess, path)
         print('++ Load model from {} ++'.format(path))
 
-    @staticmethod
-    def calculate_ranks(_pr, y_true):
-        y_true = np.reshape(y_true, [-1])
-        rows_idx = [i for i in range(len(y_true)) if y_true[i] != 0]
-        mask_rows_idx = [[i] for i in range(len(y_true)) if y_true[i] != 0]
-        mask_cols_idx = [[j] for j in y_true if j != 0]
-        ranks = (_pr[rows_idx, :] >
-                 _pr[mask_rows_idx, mask_cols_idx]).sum(axis=1) + 1
-        return ranks, len(rows_idx)
-
-    @staticmethod
-    def evaluate(ranks, top):
-        count_true = [0.] * len(top)
-        rr = [0.] * len(top)
-
-        for i, n in enumerate(top):
-            true_predict = ranks <= n
-            count_true[i] += true_predict.sum()
-            rr[i] += (1. / ranks[true_predict]).sum()
-        return count_true, rr
+    calculate_ranks = staticmethod(calculate_ranks)
+    evaluate = staticmethod(evaluate)
+
+    def quantize_weights(self, mode, axes):
+        """
+        Replace variables by their quantized then dequantized values, so the
+        evaluation measures the quantization error.
+        :param axes: variable name -> axis reduced by the int8 scales
+        :return: bytes of the variables in float32 and once quantized
+        """
+        variables = {v.op.name: v for v in tf.global_variables()}
+        nbytes, quantized_nbytes = 0, 0
+        for name, axis in axes.items():
+            if name not in variables:
+                continue
+            value = self.sess.run(variables[name])
+            values, scale = quantize(value, mode, axis)
+            variables[name].load(dequantize(values, scale), self.sess)
+            nbytes += value.nbytes
+            quantized_nbytes += values.nbytes + \
+                (0 if scale is None else scale.nbytes)
+        return nbytes, quantized_nbytes
 
     def run_predict(self, session, pos):
         feed_dict = {
@@ -97,36 +105,50 @@ class UserGruEval(BaseEval):
                     print(session[0])
 
     def run_evaluation(self):
-        self.data_loader.next_epoch()
-        acc = np.array([0.] * 2, dtype=np.float32)
-        mrr = np.array([0.] * 2, dtype=np.float32)
+        acc, mrr, num_events_eval = self.run_evaluation_counts()
+        acc /= num_events_eval
+        mrr /= num_events_eval
+
+        return acc, mrr
+
+    def run_evaluation_counts(self):
+        """
+        Hit counts, reciprocal rank sums and number of evaluated events,
+        before normalization, so results of several shards can be merged.
+        """
+        if self.model.dataset is not None:
+            self.model.dataset.initialize(self.sess, self.data_loader)
+        else:
+            self.batches.next_epoch()
+        self.compute_time = 0.
+        acc = np.zeros(len(self.config.cutoffs), dtype=np.float64)
+        mrr = np.zeros(len(self.config.cutoffs), dtype=np.float64)
         num_events_eval = 0
-        while self.data_loader.has_next():
-            batch_cp, batch_rr, batch_events = self.eval_step()
+        while self.model.dataset is not None or self.batches.has_next():
+            try:
+                batch_cp, batch_rr, batch_events = self.eval_step()
+            except tf.errors.OutOfRangeError:
+                break
             acc += batch_cp
             mrr += batch_rr
             num_events_eval += batch_events
 
-        acc /= num_events_eval
-        mrr /= num_events_eval
+        # The dataset gathers sessions without going through next_batch
+        if self.model.dataset is None and \
+                hasattr(self.data_loader, 'num_events_eval_served'):
+            assert num_events_eval == self.data_loader.num_events_eval_served
 
-        return acc, mrr
+        return acc, mrr, num_events_eval
 
     def eval_step(self):
-        batch_data = self.data_loader.next_batch()
-
-        feed_dict = {
-            self.model.user: batch_data[:, :-1, 0],
-            self.model.item: batch_data[:, :-1, 1],
-            self.model.day_of_week: batch_data[:, :-1, 3],
-            self.model.month_period: batch_data[:, :-1, 4],
-            self.model.next_items: batch_data[:, 1:, 1],
-            self.model.keep_pr: 1
-        }
-        pr = self.sess.run(self.model.get_output(), feed_dict=feed_dict)
-        assert len(pr) != 1
-        batch_ranks, num_events = \
-            self.calculate_ranks(pr, batch_data[:, 1:, 1])
-        batch_cp, batch_rr = self.evaluate(batch_ranks, [5, 20])
+        columns = None
+        if self.model.dataset is None:
+            columns = self.batches.next_batch()
+
+        feed_dict = self.model.get_feed_dict(columns)
+        start = time()
+        batch_cp, batch_rr, num_events = self.sess.run(
+            self.model.get_eval_ops(), feed_dict=feed_dict)
+        self.compute_time += time() - start
 
         return batch_cp, batch_rr, num_events
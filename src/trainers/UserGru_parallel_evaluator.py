@@ -0,0 +1,66 @@
+import sys
+sys.path.append('../..')  # noqa
+
+import multiprocessing
+from time import time
+
+import numpy as np
+
+
+def _evaluate_shard(config, checkpoint, shard_index, num_shards,
+                    num_threads):
+    # TF is imported in the worker, every process owns its graph and session
+    import tensorflow as tf
+
+    from src.data_loader.data_loader import DataLoader
+    from src.models.UserGru import UserGruModel
+    from src.trainers.UserGru_evaluator import UserGruEval
+
+    num_cutoffs = len(config.cutoffs)
+    loader = DataLoader(config.test_path, config,
+                        shard=(shard_index, num_shards))
+    if loader.get_num_sessions() == 0:
+        return np.zeros(num_cutoffs), np.zeros(num_cutoffs), 0
+
+    config.streaming = 0
+    config.input_mode = 'placeholder'
+    sess = tf.Session(config=tf.ConfigProto(
+        device_count={'GPU': 0},
+        intra_op_parallelism_threads=num_threads,
+        inter_op_parallelism_threads=1))
+    model = UserGruModel(config)
+    evaluator = UserGruEval(sess, model, config, loader)
+    evaluator.load(checkpoint)
+    counts = evaluator.run_evaluation_counts()
+    sess.close()
+    return counts
+
+
+def run_parallel_evaluation(config, checkpoint, num_workers):
+    """
+    Evaluate the test set in num_workers processes, each restoring its own
+    session on a batch-aligned shard of the test sessions. Hit counts and
+    reciprocal rank sums are merged before normalization, so the result
+    matches the serial evaluation.
+    """
+    start = time()
+    num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(num_workers) as pool:
+        results = pool.starmap(
+            _evaluate_shard,
+            [(config, checkpoint, i, num_workers, num_threads)
+             for i in range(num_workers)])
+
+    acc = np.zeros(len(config.cutoffs), dtype=np.float64)
+    mrr = np.zeros(len(config.cutoffs), dtype=np.float64)
+    num_events_eval = 0
+    for shard_acc, shard_mrr, shard_events in results:
+        acc += shard_acc
+        mrr += shard_mrr
+        num_events_eval += shard_events
+    print('++ Parallel evaluation: {} workers - {} events - '
+          'Time: {:.5f} ++'.format(num_workers, num_events_eval,
+                                   time() - start))
+
+    return acc / num_events_eval, mrr / num_events_eval
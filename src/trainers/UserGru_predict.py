@@ -2,44 +2,101 @@ import sys
 sys.path.append('../..')
 
 import numpy as np
-import tensorflow as tf
 
 from time import time
 
+from src.utils.item_index import ItemIndex, get_index_path
+from src.utils.metrics import calculate_ranks, evaluate
 from src.utils.qpath import *
 
 
+def map_state(fn, *states):
+    """
+    Apply fn to the arrays of recurrent states with the same structure,
+    nested tuples (LSTMStateTuple included) or lists of arrays.
+    """
+    if isinstance(states[0], (tuple, list)):
+        mapped = [map_state(fn, *s) for s in zip(*states)]
+        if hasattr(states[0], '_fields'):
+            return type(states[0])(*mapped)
+        return type(states[0])(mapped)
+    return fn(*states)
+
+
 class UserGruPredict():
     def __init__(self, sess, model, config):
         self.config = config
         self.model = model
         self.sess = sess
-        self.saver = tf.train.Saver()
+        # The NumPy engine runs without session, graph or checkpoint restore
+        self.engine = getattr(model, 'numpy_engine', False)
+        if config.step_inference and not self.engine:
+            self.model.build_step_model()
+        if config.retrieval and config.combination == 'voting':
+            raise ValueError('Retrieval needs an output layer, the voting '
+                             'combination has none')
+        self.index = None
+        # A frozen model holds its weights as constants
+        self.saver = None
+        if not getattr(model, 'frozen', False) and not self.engine:
+            # TF is only imported for graph models, the NumPy engine runs
+            # without it
+            import tensorflow as tf
+
+            self.saver = tf.train.Saver()
 
     def load(self, path):
-        self.saver.restore(self.sess, path)
-        print('++ Load model from {} ++'.format(path))
+        if self.saver is not None:
+            self.saver.restore(self.sess, path)
+            print('++ Load model from {} ++'.format(path))
+        if self.config.retrieval:
+            self.index = ItemIndex.load(get_index_path(path))
+            print('++ Load item index with {} clusters ++'.format(
+                self.index.num_clusters))
 
-    @staticmethod
-    def calculate_ranks(_pr, y_true):
-        y_true = np.reshape(y_true, [-1])
-        rows_idx = [i for i in range(len(y_true)) if y_true[i] != 0]
-        mask_rows_idx = [[i] for i in range(len(y_true)) if y_true[i] != 0]
-        mask_cols_idx = [[j] for j in y_true if j != 0]
-        ranks = (_pr[rows_idx, :] >
-                 _pr[mask_rows_idx, mask_cols_idx]).sum(axis=1) + 1
-        return ranks, len(rows_idx)
+    calculate_ranks = staticmethod(calculate_ranks)
+    evaluate = staticmethod(evaluate)
 
     @staticmethod
-    def evaluate(ranks, top):
-        count_true = [0.] * len(top)
-        rr = [0.] * len(top)
+    def get_top_items(pr, current_item, k=10, exclude=()):
+        """
+        Top k items of a probability row and their scores, skipping the
+        padding item, the current item and the excluded items.
+        """
+        skip = set(exclude)
+        skip.update((0, int(current_item)))
+        n = min(k + len(skip), len(pr))
+        top_id = np.argpartition(pr, -n)[-n:]
+        top_id = top_id[np.argsort(pr[top_id])[::-1]]
+        top_id = [i for i in top_id.tolist() if i not in skip][:k]
+
+        return top_id, pr[top_id].tolist()
+
+    def get_option(self, option):
+        """
+        (k, exclude) of a request, None for the serving defaults.
+        """
+        if option is None:
+            return self.config.top_k, ()
+        return option
 
-        for i, n in enumerate(top):
-            true_predict = ranks <= n
-            count_true[i] += true_predict.sum()
-            rr[i] += (1. / ranks[true_predict]).sum()
-        return count_true, rr
+    def get_top_items_index(self, queries, current_items, options):
+        """
+        Top items of a batch of final states searched in the item index.
+        Scores are logits, the softmax needs every item.
+        """
+        options = [self.get_option(o) for o in options]
+        n = max(k + len(exclude) for k, exclude in options) + 1
+        ids, scores = self.index.search(queries, n, self.config.nprobe)
+        results = []
+        for row_ids, row_scores, item, (k, exclude) in zip(
+                ids.tolist(), scores.tolist(), current_items, options):
+            skip = set(exclude)
+            skip.update((-1, int(item)))
+            kept = [(i, s) for i, s in zip(row_ids, row_scores)
+                    if i not in skip][:k]
+            results.append(([i for i, _ in kept], [s for _, s in kept]))
+        return results
 
     def run_predict(self, session, pos):
         feed_dict = {
@@ -69,15 +126,146 @@ class UserGruPredict():
             print('Item attention: ', attention[0][0][pos][0])
             print('User attention: ', attention[1][0][pos][0])
 
-        top_id = np.argpartition(pr, -12)[-12:]
-        top_id = top_id[np.argsort(pr[top_id])[::-1]]
-        top_id = list(top_id)
-        if 0 in top_id:
-            del top_id[top_id.index(0)]
-        if current_item in top_id:
-            del top_id[top_id.index(current_item)]
+        return self.get_top_items(pr, current_item)[0]
+
+    def predict_sessions(self, sessions, final_state=False):
+        """
+        Output distribution, or final states, of padded sessions.
+        :param sessions: [batch, max_length + 1, 4] array of
+                         (user, item, day, half month)
+        :return: [batch, max_length, -1] array
+        """
+        if self.engine:
+            columns = {
+                'user': sessions[:, :-1, 0],
+                'item': sessions[:, :-1, 1],
+                'day_of_week': sessions[:, :-1, 2],
+                'month_period': sessions[:, :-1, 3],
+                'next_items': sessions[:, 1:, 1]
+            }
+            pr, states = self.model.run(columns, output=not final_state)
+            output = states if final_state else pr
+        else:
+            feed_dict = {
+                self.model.user: sessions[:, :-1, 0],
+                self.model.item: sessions[:, :-1, 1],
+                self.model.day_of_week: sessions[:, :-1, 2],
+                self.model.month_period: sessions[:, :-1, 3],
+                self.model.next_items: sessions[:, 1:, 1],
+                self.model.keep_pr: 1
+            }
+            output = self.sess.run(
+                self.model.get_final_state() if final_state
+                else self.model.get_output(), feed_dict=feed_dict)
+        return np.reshape(output, [len(sessions), self.config.max_length, -1])
+
+    def predict_step(self, events, state, predict=True, final_state=False):
+        """
+        :return: output distribution, or final states, of one step (None if
+                 predict is False) and the next recurrent state
+        """
+        if self.engine:
+            pr, next_state, states = self.model.step(
+                events, state, output=predict and not final_state)
+            if not predict:
+                return None, next_state
+            return states if final_state else pr, next_state
+        feed_dict = self.model.get_step_feed_dict(events, state)
+        output, next_state = self.model.get_step_output()
+        if not predict:
+            return None, self.sess.run(next_state, feed_dict=feed_dict)
+        if final_state:
+            output = self.model.get_step_final_state()
+        return self.sess.run([output, next_state], feed_dict=feed_dict)
+
+    def run_predict_batch(self, sessions, positions, options=None):
+        """
+        Top items of several padded sessions in one sess.run.
+        :param sessions: [batch, max_length + 1, 4] array of
+                         (user, item, day, half month)
+        :param positions: position of the last real event of every session
+        :param options: optional (k, exclude) of every session
+        :return: list of (top items, scores)
+        """
+        if options is None:
+            options = [None] * len(sessions)
+        if self.index is not None:
+            final_state = self.predict_sessions(sessions, final_state=True)
+            rows = np.arange(len(sessions))
+            return self.get_top_items_index(
+                final_state[rows, positions], sessions[rows, positions, 1],
+                options)
+        pr = self.predict_sessions(sessions)
+        return [self.get_top_items(pr[b, pos], sessions[b, pos, 1],
+                                   *self.get_option(options[b]))
+                for b, pos in enumerate(positions)]
+
+    def run_step_batch(self, requests):
+        """
+        Run one step for several independent sessions in one sess.run.
+        :param requests: list of (event, state, option) with the state of a
+                         single session, None for a new session
+        :return: list of ((top items, scores), next state)
+        """
+        events = np.array([e for e, _, _ in requests], dtype=np.int32)
+        states = [self.model.get_step_zero_state(1) if s is None else s
+                  for _, s, _ in requests]
+        state = map_state(lambda *x: np.concatenate(x), *states)
+        top_items, next_state = self.run_step(
+            events, state, options=[o for _, _, o in requests])
+        return [(top_items[b],
+                 map_state(lambda x: x[b:b + 1], next_state))
+                for b in range(len(requests))]
+
+    def run_step(self, events, state, predict=True, options=None):
+        """
+        Advance a batch of sessions by one event each.
+        :param events: [batch, 4] array of (user, item, day, half month)
+        :param state: recurrent state of the sessions
+        :param options: optional (k, exclude) of every session
+        :return: (top items, scores) per session (None if predict is False)
+                 and the updated recurrent state
+        """
+        if not predict:
+            return self.predict_step(events, state, predict=False)
+        if options is None:
+            options = [None] * len(events)
+        if self.index is not None:
+            final_state, next_state = self.predict_step(
+                events, state, final_state=True)
+            return self.get_top_items_index(
+                final_state, events[:, 1], options), next_state
+        pr, next_state = self.predict_step(events, state)
+        top_items = [self.get_top_items(p, e[1], *self.get_option(o))
+                     for p, e, o in zip(pr, events, options)]
+        return top_items, next_state
 
-        return top_id[:10]
+    def run_session_steps(self, events, state, offset=0, step_fn=None,
+                          option=None):
+        """
+        Feed the events of one session step by step from state.
+        The state is reset every max_length events, the same way
+        preprocessing cuts long sessions.
+        :param offset: position of events[0] in the session
+        :param step_fn: optional function (event, state, option) ->
+                        ((top items, scores), next state), e.g. a
+                        micro-batcher
+        :param option: (k, exclude) of the recommendation
+        :return: (top items, scores) after the last event and the final state
+        """
+        top_items = None
+        for j, event in enumerate(events):
+            if (offset + j) % self.config.max_length == 0:
+                state = self.model.get_step_zero_state(1)
+            if step_fn is not None:
+                top_items, state = step_fn(event, state, option)
+            else:
+                top_items, state = self.run_step(
+                    np.array([event], dtype=np.int32), state,
+                    predict=j == len(events) - 1, options=[option])
+                if top_items is not None:
+                    top_items = top_items[0]
+        return top_items, state
 
     def run_test(self):
         pos = 0
@@ -133,6 +321,6 @@ class UserGruPredict():
         assert len(pr) != 1
         batch_ranks, num_events = \
             self.calculate_ranks(pr, batch_data[:, 1:, 1])
-        batch_cp, batch_rr = self.evaluate(batch_ranks, [5, 20])
+        batch_cp, batch_rr = self.evaluate(batch_ranks, self.config.cutoffs)
 
         return batch_cp, batch_rr, num_events
@@ -7,7 +7,8 @@ import numpy as np
 import tensorflow as tf
 
 from src.base.base_train import BaseTrain
-from src.data_loader.data_loader import DataLoader
+from src.data_loader.data_loader import get_data_loader
+from src.data_loader.prefetcher import BatchPrefetcher
 from src.trainers.UserGru_evaluator import UserGruEval
 from src.utils.qpath import CHECKPOINT_DIR
 
@@ -16,8 +17,11 @@ class UserGruTrainer(BaseTrain):
     def __init__(self, sess, model, config, data_loader, logger=None):
         super(UserGruTrainer, self).__init__(
             sess, model, config, data_loader, logger)
+        self.batches = BatchPrefetcher(data_loader, config.prefetch_depth)
+        self._compute_time = 0.
+
         if config.test_path is not None:
-            self.test_loader = DataLoader(config.test_path, config)
+            self.test_loader = get_data_loader(config.test_path, config)
             self.evaluator = UserGruEval(sess, model, config, self.test_loader)
             self.best_acc = 0
 
@@ -26,11 +30,14 @@ class UserGruTrainer(BaseTrain):
     def run_training(self):
         for epoch in range(self.config.num_epoch):
             start = time()
-            self.data_loader.next_epoch(shuffle=True)
+            self.next_epoch(self.data_loader, shuffle=True)
+            self._compute_time = 0.
             epoch_loss = self.train_epoch()
 
-            print('++ Epoch: {} - Loss: {:.5f} - Time: {:.5f} ++'.format(
-                  epoch, epoch_loss, time() - start))
+            print('++ Epoch: {} - Loss: {:.5f} - Time: {:.5f} '
+                  '(data: {:.5f} - compute: {:.5f}) ++'.format(
+                      epoch, epoch_loss, time() - start,
+                      self.batches.epoch_wait, self._compute_time))
 
             if self.config.test_path is not None \
                     and epoch % self.config.eval_every == 0:
@@ -39,20 +46,31 @@ class UserGruTrainer(BaseTrain):
                     self.best_acc = acc[0]
                     self.save(CHECKPOINT_DIR + self.config.name + '-best.ckpt')
                 print('++ Evaluate result on val set ++')
-                for k, r, m in zip([5, 20], acc, mrr):
+                for k, r, m in zip(self.config.cutoffs, acc, mrr):
                     print('Recall@{}: {:.4f}  -  MRR@{}: {:.4f}'.format(
                         k, r, k, m))
 
+    def next_epoch(self, data_loader, shuffle=False):
+        if self.model.dataset is not None:
+            self.model.dataset.initialize(self.sess, data_loader, shuffle)
+        else:
+            self.batches.next_epoch(shuffle=shuffle)
+
     def train_epoch(self):
         losses = []
-        while self.data_loader.has_next():
+        while self.model.dataset is not None or self.batches.has_next():
             start = time()
-            loss, step = self.train_step()
+            try:
+                loss, step, compute_time = self.train_step()
+            except tf.errors.OutOfRangeError:
+                break
             losses.append(loss)
 
             if step % self.config.display_every == 0:
-                print('Step : {} - Loss: {:.5f} ' '- Time: {:.5f}'.format(
-                    step, loss, time() - start))
+                print('Step : {} - Loss: {:.5f} - Time: {:.5f} '
+                      '(data: {:.5f} - compute: {:.5f})'.format(
+                          step, loss, time() - start,
+                          self.batches.last_wait, compute_time))
 
             if step % self.config.save_every == 0:
                 self.save(CHECKPOINT_DIR + self.config.name + '.ckpt')
@@ -60,18 +78,16 @@ class UserGruTrainer(BaseTrain):
         return np.mean(losses)
 
     def train_step(self):
-        batch_data = self.data_loader.next_batch()
-        feed_dict = {
-            self.model.user: batch_data[:, :-1, 0],
-            self.model.item: batch_data[:, :-1, 1],
-            self.model.day_of_week: batch_data[:, :-1, 3],
-            self.model.month_period: batch_data[:, :-1, 4],
-            self.model.next_items: batch_data[:, 1:, 1],
-            self.model.keep_pr: self.config.keep_pr
-        }
+        columns = None
+        if self.model.dataset is None:
+            columns = self.batches.next_batch()
+        feed_dict = self.model.get_feed_dict(columns, self.config.keep_pr)
+        start = time()
         _, batch_loss, step = self.sess.run(self.model.get_training_vars(),
                                             feed_dict=feed_dict)
-        return batch_loss, step
+        compute_time = time() - start
+        self._compute_time += compute_time
+        return batch_loss, step, compute_time
 
     def save(self, path):
         save_path = self.saver.save(self.sess, path)
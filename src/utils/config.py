@@ -21,6 +21,14 @@ class Args:
         self.test_path = PROCESSED_DATA_DIR + 'clean-lastfm-test'
         self.data_stats = PROCESSED_DATA_DIR + 'clean-lastfm-train-metadata'
 
+        # Data loading
+        self.streaming = 0
+        self.block_size = 10000
+        self.shuffle_buffer = 10000
+        self.prefetch_depth = 0
+        self.input_mode = 'placeholder'
+        self.num_parallel_calls = 4
+
         # Data stats
         self.num_users = None
         self.num_items = None
@@ -38,6 +46,38 @@ class Args:
         self.keep_pr = 1
         self.num_epoch = 20
         self.batch_size = 50
+        self.loss = 'softmax'
+        self.num_sampled = 100
+        self.sampling_distortion = 0.75
+        self.item_counts = None
+
+        # Evaluation
+        self.cutoffs = [5, 20]
+        self.num_workers = 1
+
+        # Serving
+        self.step_inference = 0
+        self.cache_mb = 256
+        self.cache_ttl = 3600
+        self.max_batch_size = 32
+        self.max_delay_ms = 2.
+        self.top_k = 10
+        self.max_k = 100
+        self.server_mode = 'sync'
+        self.inference_threads = 4
+        self.max_pending = 256
+        self.max_concurrent_rpcs = 0
+        self.grace_period = 10.
+        self.retrieval = 0
+        self.nprobe = 8
+        self.num_clusters = 0
+        self.num_queries = 10000
+        self.num_servers = 1
+        self.frozen = 0
+        self.quantize = None
+        self.engine = 'tf'
+        self.inference_only = 0
+        self.shared_weights = None
 
         # Logging
         self.display_every = 500
@@ -60,6 +100,14 @@ class Args:
             self.test_path = None
         self.data_stats = PROCESSED_DATA_DIR + args.train_file + '-metadata'
 
+        # Data loading
+        self.streaming = args.streaming
+        self.block_size = args.block_size
+        self.shuffle_buffer = args.shuffle_buffer
+        self.prefetch_depth = args.prefetch_depth
+        self.input_mode = args.input_mode
+        self.num_parallel_calls = args.num_parallel_calls
+
         # Hyper params
         self.cell = args.cell
         self.num_layers = args.num_layers
@@ -72,6 +120,35 @@ class Args:
         self.keep_pr = args.keep_pr
         self.num_epoch = args.num_epoch
         self.batch_size = args.batch_size
+        self.loss = args.loss
+        self.num_sampled = args.num_sampled
+        self.sampling_distortion = args.sampling_distortion
+
+        # Evaluation
+        self.cutoffs = args.cutoffs
+        self.num_workers = args.num_workers
+
+        # Serving
+        self.step_inference = args.step_inference
+        self.cache_mb = args.cache_mb
+        self.cache_ttl = args.cache_ttl
+        self.max_batch_size = args.max_batch_size
+        self.max_delay_ms = args.max_delay_ms
+        self.top_k = args.top_k
+        self.max_k = args.max_k
+        self.server_mode = args.server_mode
+        self.inference_threads = args.inference_threads
+        self.max_pending = args.max_pending
+        self.max_concurrent_rpcs = args.max_concurrent_rpcs
+        self.grace_period = args.grace_period
+        self.retrieval = args.retrieval
+        self.nprobe = args.nprobe
+        self.num_clusters = args.num_clusters
+        self.num_queries = args.num_queries
+        self.num_servers = args.num_servers
+        self.frozen = args.frozen
+        self.quantize = None if args.quantize == 'none' else args.quantize
+        self.engine = args.engine
 
         # Logging
         self.display_every = args.display_every
@@ -0,0 +1,159 @@
+import json
+import os
+import shutil
+from time import time
+
+import numpy as np
+
+
+class ItemIndex(object):
+    """
+    Clustered (IVF) index for maximum inner product search over the output
+    layer, score(h, j) = h . w_fc[j] + b_fc[j].
+    Items are augmented to x_j = [w_j, b_j, sqrt(M^2 - |w_j, b_j|^2)] so that
+    all of them have norm M and the inner product with [h, 1, 0] is the
+    logit, then grouped by spherical k-means. A query scores the centroids,
+    probes the nprobe best clusters and ranks their items exactly.
+    The padding item 0 is not indexed.
+    """
+    def __init__(self, centroids, vectors, item_ids, offsets):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.item_ids = item_ids
+        self.offsets = offsets
+
+    @property
+    def num_clusters(self):
+        return len(self.centroids)
+
+    @staticmethod
+    def augment(w, b):
+        items = np.concatenate([w, b[:, None]], axis=1).astype(np.float32)
+        norms = np.sum(items * items, axis=1)
+        extra = np.sqrt(np.maximum(norms.max() - norms, 0.))
+        return np.concatenate([items, extra[:, None]], axis=1)
+
+    @staticmethod
+    def augment_queries(queries):
+        n = len(queries)
+        return np.concatenate([queries, np.ones([n, 1], np.float32),
+                               np.zeros([n, 1], np.float32)], axis=1)
+
+    @staticmethod
+    def _assign(items, centroids, chunk_size=65536):
+        assignment = np.empty(len(items), dtype=np.int64)
+        for s in range(0, len(items), chunk_size):
+            assignment[s:s + chunk_size] = np.argmax(
+                np.dot(items[s:s + chunk_size], centroids.T), axis=1)
+        return assignment
+
+    @classmethod
+    def build(cls, w, b, num_clusters=0, num_iters=10, sample_size=200000,
+              seed=0):
+        """
+        :param w: [num_items + 1, hidden] output weights
+        :param b: [num_items + 1] output bias
+        :param num_clusters: 0 for 4 * sqrt(num_items)
+        """
+        items = cls.augment(np.asarray(w)[1:], np.asarray(b)[1:])
+        num_items = len(items)
+        if num_clusters <= 0:
+            num_clusters = int(4 * np.sqrt(num_items))
+        num_clusters = max(1, min(num_clusters, num_items))
+
+        rng = np.random.RandomState(seed)
+        unit = items / np.maximum(
+            np.linalg.norm(items, axis=1, keepdims=True), 1e-12)
+        sample = unit
+        if num_items > sample_size:
+            sample = unit[rng.choice(num_items, sample_size, replace=False)]
+        centroids = sample[rng.choice(len(sample), num_clusters,
+                                      replace=False)]
+        for _ in range(num_iters):
+            assignment = cls._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=num_clusters)
+            # Restart empty clusters from random points
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(len(sample), empty.sum())]
+            centroids = sums / np.maximum(
+                np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        assignment = cls._assign(unit, centroids)
+        order = np.argsort(assignment, kind='stable')
+        counts = np.bincount(assignment, minlength=num_clusters)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(centroids.astype(np.float32), items[order],
+                   (order + 1).astype(np.int32), offsets)
+
+    def search(self, queries, k=10, nprobe=8):
+        """
+        :param queries: [n, hidden] final states
+        :return: [n, k] item ids and logits, padded with -1 / -inf when the
+                 probed clusters hold fewer than k items
+        """
+        queries = self.augment_queries(np.asarray(queries, np.float32))
+        nprobe = min(nprobe, self.num_clusters)
+        probes = np.argpartition(-np.dot(queries, self.centroids.T),
+                                 nprobe - 1, axis=1)[:, :nprobe]
+        ids = np.full([len(queries), k], -1, dtype=np.int32)
+        scores = np.full([len(queries), k], -np.inf, dtype=np.float32)
+        for n, query in enumerate(queries):
+            candidates = np.concatenate(
+                [np.arange(self.offsets[c], self.offsets[c + 1])
+                 for c in probes[n]])
+            logits = np.dot(self.vectors[candidates], query)
+            top = min(k, len(candidates))
+            best = np.argpartition(-logits, top - 1)[:top]
+            best = best[np.argsort(-logits[best])]
+            ids[n, :top] = self.item_ids[candidates[best]]
+            scores[n, :top] = logits[best]
+        return ids, scores
+
+    def exact_search(self, queries, k=10):
+        logits = np.dot(self.augment_queries(
+            np.asarray(queries, np.float32)), self.vectors.T)
+        best = np.argpartition(-logits, k - 1, axis=1)[:, :k]
+        best = np.take_along_axis(best, np.argsort(
+            -np.take_along_axis(logits, best, axis=1), axis=1), axis=1)
+        return self.item_ids[best], np.take_along_axis(logits, best, axis=1)
+
+    def measure_recall(self, queries, k=10, nprobe=8):
+        """
+        Recall@k of the index against exact search and the time of both.
+        :return: recall, exact search time, index search time (seconds)
+        """
+        start = time()
+        exact, _ = self.exact_search(queries, k)
+        exact_time = time() - start
+        start = time()
+        found, _ = self.search(queries, k, nprobe)
+        index_time = time() - start
+        hits = sum(len(np.intersect1d(e, f)) for e, f in zip(exact, found))
+        return float(hits) / exact.size, exact_time, index_time
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name in ['centroids', 'vectors', 'item_ids', 'offsets']:
+            np.save(os.path.join(tmp_path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'num_clusters': self.num_clusters,
+                       'num_items': len(self.item_ids)}, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        return cls(*[np.load(os.path.join(path, name + '.npy'),
+                             mmap_mode='r' if mmap else None)
+                     for name in ['centroids', 'vectors', 'item_ids',
+                                  'offsets']])
+
+
+def get_index_path(checkpoint):
+    return checkpoint + '.ivf'
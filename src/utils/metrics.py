@@ -0,0 +1,31 @@
+import numpy as np
+
+
+def calculate_ranks(_pr, y_true, chunk_size=4096):
+    """
+    Rank of every non-padded target item in its row of the score matrix.
+    Rows are compared in chunks of views, the score matrix is never copied.
+    :param _pr: [batch * max_length, num_items + 1] scores
+    :param y_true: target item ids, 0 for padded positions
+    :return: ranks of the real targets and their number
+    """
+    y_true = np.reshape(y_true, [-1])
+    target_scores = np.take_along_axis(_pr, y_true[:, None], axis=1)
+    ranks = np.empty(len(y_true), dtype=np.int64)
+    for start in range(0, len(y_true), chunk_size):
+        end = start + chunk_size
+        ranks[start:end] = np.count_nonzero(
+            _pr[start:end] > target_scores[start:end], axis=1)
+    ranks = ranks[y_true != 0] + 1
+    return ranks, len(ranks)
+
+
+def evaluate(ranks, top):
+    """
+    Hit counts and reciprocal rank sums of the given ranks for every cutoff.
+    """
+    ranks = np.asarray(ranks, dtype=np.float64)[:, None]
+    true_predict = ranks <= np.asarray(top)[None, :]
+    count_true = true_predict.sum(axis=0).astype(np.float64)
+    rr = np.where(true_predict, 1. / ranks, 0.).sum(axis=0)
+    return count_true, rr
@@ -0,0 +1,105 @@
+import numpy as np
+
+
+QUANTIZATION_MODES = ['float16', 'int8']
+
+
+def quantize(x, mode, axis=1):
+    """
+    :param x: float32 matrix
+    :param mode: 'float16' or 'int8'
+    :param axis: axis reduced by the int8 scales, 1 for one scale per row
+                 and 0 for one scale per column
+    :return: quantized values and int8 scales (None for float16)
+    """
+    x = np.asarray(x, dtype=np.float32)
+    if mode == 'float16':
+        return x.astype(np.float16), None
+    if mode != 'int8':
+        raise ValueError('Unknown quantization mode: {}'.format(mode))
+    scale = np.max(np.abs(x), axis=axis, keepdims=True) / 127.
+    scale[scale == 0] = 1.
+    values = np.clip(np.round(x / scale), -127, 127).astype(np.int8)
+    return values, scale.astype(np.float32)
+
+
+def dequantize(values, scale=None):
+    if scale is None:
+        return values.astype(np.float32)
+    return values.astype(np.float32) * scale
+
+
+class QuantizedMatrix(object):
+    """
+    Read-only float16 or int8 matrix used in place of a float32 array.
+    Indexing returns dequantized rows, x @ m dequantizes m in column chunks
+    and x @ m.T in row chunks, so the full float32 matrix is never
+    materialized.
+    """
+    # Make numpy defer x @ m to __rmatmul__
+    __array_ufunc__ = None
+
+    def __init__(self, values, scale=None, chunk_size=16384):
+        self.values = values
+        self.scale = scale
+        self.chunk_size = chunk_size
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self):
+        scale_nbytes = 0 if self.scale is None else self.scale.nbytes
+        return self.values.nbytes + scale_nbytes
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def T(self):
+        return _TransposedMatrix(self)
+
+    def __getitem__(self, ids):
+        if self.scale is None or self.scale.shape[0] == 1:
+            scale = self.scale
+        else:
+            scale = self.scale[ids]
+        return dequantize(self.values[ids], scale)
+
+    def __rmatmul__(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        column_scale = self.scale is not None and self.scale.shape[0] == 1
+        if self.scale is not None and not column_scale:
+            # One scale per row: scale the input instead of the matrix
+            x = x * self.scale[:, 0]
+        out = np.empty(x.shape[:-1] + self.shape[1:], dtype=np.float32)
+        for s in range(0, self.shape[1], self.chunk_size):
+            e = s + self.chunk_size
+            out[..., s:e] = np.dot(x, self.values[:, s:e].astype(np.float32))
+            if column_scale:
+                out[..., s:e] *= self.scale[0, s:e]
+        return out
+
+
+class _TransposedMatrix(object):
+    """
+    Transposed view of a QuantizedMatrix supporting x @ m.T only.
+    """
+    __array_ufunc__ = None
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    @property
+    def shape(self):
+        return self.matrix.shape[::-1]
+
+    def __rmatmul__(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        m = self.matrix
+        out = np.empty(x.shape[:-1] + m.shape[:1], dtype=np.float32)
+        for s in range(0, m.shape[0], m.chunk_size):
+            e = s + m.chunk_size
+            out[..., s:e] = np.dot(x, m[s:e].T)
+        return out
@@ -0,0 +1,106 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+from src.utils.quantization import QuantizedMatrix, quantize as quantize_matrix
+
+
+# Variables whose size grows with the number of users or items
+SHARED_WEIGHTS = ['embeddings/Ei', 'embeddings/Eu', 'w_fc', 'b_fc',
+                  'w_vote_u', 'b_vote_u', 'w_vote_i', 'b_vote_i']
+
+# Quantized variables and the axis reduced by their int8 scales, one scale
+# per item in both cases
+QUANTIZED_WEIGHTS = {'embeddings/Ei': 1, 'w_fc': 1}
+
+_MANIFEST = 'manifest.json'
+_SCALE = ':scale'
+
+
+def get_export_dir(checkpoint, quantize=None):
+    if quantize:
+        return checkpoint + '.weights-' + quantize
+    return checkpoint + '.weights'
+
+
+def is_stale(checkpoint, export_dir):
+    manifest = os.path.join(export_dir, _MANIFEST)
+    return not os.path.exists(manifest) or \
+        os.path.getmtime(manifest) < os.path.getmtime(checkpoint + '.index')
+
+
+def is_model_variable(name):
+    return name != 'global_step' and 'Adam' not in name and \
+        not name.endswith('_power')
+
+
+def export_weights(checkpoint, export_dir=None, names=None, quantize=None):
+    """
+    Write the variables of a checkpoint as .npy files, one per variable,
+    that processes can memory-map read-only.
+    :param names: variables to export, all model variables if None
+    :param quantize: None, 'float16' or 'int8', applied to QUANTIZED_WEIGHTS
+    :return: the export directory
+    """
+    import tensorflow as tf
+
+    if export_dir is None:
+        export_dir = get_export_dir(checkpoint, quantize)
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    available = reader.get_variable_to_shape_map()
+    if names is None:
+        names = sorted(n for n in available if is_model_variable(n))
+
+    tmp_dir = export_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    manifest = {}
+    for name in names:
+        if name not in available:
+            continue
+        value, scale = reader.get_tensor(name), None
+        if quantize and name in QUANTIZED_WEIGHTS:
+            value, scale = quantize_matrix(value, quantize,
+                                           QUANTIZED_WEIGHTS[name])
+        file_name = name.replace('/', '__') + '.npy'
+        np.save(os.path.join(tmp_dir, file_name), value)
+        manifest[name] = file_name
+        if scale is not None:
+            np.save(os.path.join(tmp_dir, 'scale_' + file_name), scale)
+            manifest[name + _SCALE] = 'scale_' + file_name
+    with open(os.path.join(tmp_dir, _MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.exists(export_dir):
+        shutil.rmtree(export_dir)
+    os.rename(tmp_dir, export_dir)
+    print('++ Export {} variables to {} ++'.format(len(manifest), export_dir))
+    return export_dir
+
+
+def load_weights(export_dir, names=None, mmap=True):
+    """
+    Load exported variables by name, memory-mapped read-only by default.
+    Quantized variables are returned as QuantizedMatrix.
+    """
+    with open(os.path.join(export_dir, _MANIFEST)) as f:
+        manifest = json.load(f)
+
+    def load(file_name):
+        return np.load(os.path.join(export_dir, file_name),
+                       mmap_mode='r' if mmap else None)
+
+    weights = {}
+    for name, file_name in manifest.items():
+        if name.endswith(_SCALE) or (names is not None and
+                                     name not in names):
+            continue
+        weights[name] = load(file_name)
+        if weights[name].dtype != np.float32:
+            scale = manifest.get(name + _SCALE)
+            weights[name] = QuantizedMatrix(
+                weights[name], None if scale is None else load(scale))
+    return weights
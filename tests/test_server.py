@@ -0,0 +1,30 @@
+import os
+import sys
+from collections import namedtuple
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'src', 'grpc'))
+
+grpc = pytest.importorskip('grpc')
+server = pytest.importorskip('server')
+
+Event = namedtuple('Event', ['user', 'item', 'date'])
+
+
+def test_get_events_reads_a_one_shot_iterator():
+    events = [Event(3, 7, '2018-08-11 10:15:30'),
+              Event(3, 9, '2018-08-11 10:20:00')]
+    assert server.ResysServicer.get_events(e for e in events) == \
+        server.ResysServicer.get_events(events) == \
+        [[3, 7, 5, 15], [3, 9, 5, 15]]
+
+
+def test_numpy_engine_does_not_write_a_missing_export(tmp_path):
+    checkpoint = str(tmp_path / 'model.ckpt')
+    open(checkpoint + '.index', 'w').close()
+    with pytest.raises(IOError, match='--mode export'):
+        server.get_shared_export(checkpoint, engine='numpy')
+    assert not os.path.exists(checkpoint + '.weights')